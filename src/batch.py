@@ -0,0 +1,53 @@
+"""
+Running many Gol><> programs at once, across a pool of worker processes
+
+Jobs are requests as described in server.py - {"code": ..., "input": ...,
+"tick_limit": ..., "time_limit": ..., "memory_limit": ...} - and each is run by a fresh Golfish
+in a worker, with its own captured output. Results are the server's
+responses, plus the job's position in the batch as "index", and are
+yielded in the order the jobs finish.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import sys
+
+try:
+    from server import Server
+except ImportError:
+    from .server import Server
+
+_server = None # per worker process, so that boards are cached across jobs
+
+
+def run_job(job):
+    global _server
+
+    if _server is None:
+        _server = Server()
+
+    return _server.respond(job)
+
+
+def run_batch(jobs, workers=None):
+    # Run jobs on workers processes (default: one per core), yielding each
+    # result as it comes in
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(run_job, job): index
+                   for index, job in enumerate(jobs)}
+
+        for future in as_completed(futures):
+            result = future.result()
+            result["index"] = futures[future]
+            yield result
+
+
+def run_batch_file(path, workers=None):
+    # Run the jobs in a JSON lines file, writing results to stdout as JSON
+    # lines as they come in
+    with open(path) as infile:
+        jobs = [json.loads(line) for line in infile if line.strip()]
+
+    for result in run_batch(jobs, workers):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,345 @@
+"""
+Microbenchmarks for the Gol><> interpreter
+
+Usage: python benchmarks.py [benchmark ...]
+
+Runs every benchmark if none are named. Timings are best-of-5 and are
+only meaningful relative to each other on the same machine.
+"""
+
+import io
+import os
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from batch import run_batch
+from golfish import Golfish, HaltProgram, IfBookmark
+from library import is_probably_prime
+
+DISPATCH_OPCODES = "0:$+~z{}|"
+
+# The order handle_normal_instruction tested instructions in when it was an
+# if/elif chain, for the "before" column of bench_dispatch. Each entry is a
+# branch: a string of several chars was tested with "in".
+CHAIN_ORDER = (["<>^v", "/\\#", "0123456789abcdef", " ", "!", "\"'"]
+               + list("$%&()*+,-.:;=?@ABCDEFHIJKLMNPQRSTVWXZ[]`ghijklmnopqrstuwxyz{|}~"))
+
+# Loop-heavy programs from unittests_examples.py, with larger inputs
+EXAMPLES = [("1 to n", "IFLPN|;", "3000"),
+            ("factorial", "1IFLP*|h", "500"),
+            ("iterative fib", "10IT:zq~hM}:@+{t", "2000"),
+            ("collatz", "IT:NM:Z;P3*:2%qPt6,t", "837799"),
+            ("fizz buzz", '`e2RFL5%zR"zzuB"L3%zR"zziF"lQlRoaoC|LN|;', None),
+            ("counting sort", "iEv:2gP$2p\nrH>ff*FL2gRL|", "Hello, World!" * 20),
+            ("cat", "iE;o", "Hello, World!" * 100)]
+
+# Programs dominated by digit pushes, comparisons and stack shuffling
+ARITHMETIC = [("sum 1..n", "0IFLP+|n;", "5000"),
+              ("digit sum", "0IT:a%@+$aS,:?t~n;", "9" * 15),
+              ("comparisons", "0aaa**FL2%:{(+L3(+|n;", None),
+              ("dup/swap", "12aaa**F:@$~$|+n;", None)]
+
+
+def best_of(func, number, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def run_program(code, input_=None):
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+
+    try:
+        Golfish(code, input_, online=True).run()
+    finally:
+        sys.stdout = stdout
+
+
+def bench_examples():
+    print("Example programs (ms/run)")
+
+    for name, code, input_ in EXAMPLES:
+        cost = best_of(lambda: run_program(code, input_), 3)
+        print("  {:14}  {:8.2f}".format(name, cost * 1e3))
+
+
+def bench_allocations():
+    # Memory allocated on top of what was already live during each call to
+    # tick(), i.e. short-lived objects such as copied positions, averaged
+    # over the whole run
+    print("Transient allocations per tick (bytes)")
+
+    if hasattr(tracemalloc, "reset_peak"):
+        reset_peak = tracemalloc.reset_peak
+    else:
+        # Before Python 3.9, restarting is the only way, and forgets what
+        # was already live, which is just as good here
+        def reset_peak():
+            tracemalloc.stop()
+            tracemalloc.start()
+
+    for name, code, input_ in EXAMPLES:
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        gf = Golfish(code, input_, online=True)
+        total = calls = 0
+        tracemalloc.start()
+
+        try:
+            while True:
+                reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                gf.tick()
+                total += tracemalloc.get_traced_memory()[1] - before
+                calls += 1
+
+        except HaltProgram:
+            pass
+
+        finally:
+            tracemalloc.stop()
+            sys.stdout = stdout
+
+        print("  {:14}  {:8.1f}".format(name, total / max(calls, 1)))
+
+
+def bench_arithmetic():
+    # Integer pushes skip push's normalisation, which is measured here by
+    # running the same programs with every push normalising again
+    print("Arithmetic-heavy programs (ms/run)")
+    push_int = Golfish.push_int
+
+    for name, code, input_ in ARITHMETIC:
+        costs = []
+
+        for normalise in [True, False]:
+            Golfish.push_int = Golfish.push if normalise else push_int
+
+            try:
+                costs.append(best_of(lambda: run_program(code, input_), 3))
+            finally:
+                Golfish.push_int = push_int
+
+        print("  {:14}  {:8.2f}  (normalising every push: {:.2f})".format(
+              name, costs[1] * 1e3, costs[0] * 1e3))
+
+
+def bench_recursion():
+    # Peak memory of recursing n deep through an A alias, which keeps one
+    # FunctionBookmark per level on the bookmark stack
+    code = "1AFIFn;\n:0=?BMFB"
+    print("Alias recursion, n levels deep (peak KiB)")
+
+    for n in [10**3, 10**4, 10**5]:
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        tracemalloc.start()
+
+        try:
+            Golfish(code, str(n), online=True).run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            sys.stdout = stdout
+
+        print("  n = {:<8}  {:8.1f}".format(n, peak / 1024))
+
+
+def bench_memoize():
+    # Recursive Fibonacci through an A alias, with and without the results
+    # of pure calls cached
+    code = "1AFIFh\n:2(?BM:MF$F+B"
+    print("Recursive fib, n = 18 (ms/run)")
+
+    for memoize in [False, True]:
+        def run(memoize=memoize):
+            stdout, sys.stdout = sys.stdout, io.StringIO()
+
+            try:
+                Golfish(code, "18", online=True, memoize_aliases=memoize).run()
+            finally:
+                sys.stdout = stdout
+
+        cost = best_of(run, 1)
+        print("  {:14}  {:8.2f}".format("memoized" if memoize else "plain", cost * 1e3))
+
+
+def bench_primes():
+    # is_probably_prime, as used by SP, over 10**6 consecutive numbers from
+    # within the sieve up to beyond 64 bits
+    print("SP over 10**6 consecutive numbers (ms/run)")
+
+    for label, start in [("0", 0), ("10**6", 10**6), ("10**12", 10**12),
+                         ("10**18", 10**18), ("10**24", 10**24)]:
+        numbers = range(start, start + 10**6)
+        cost = best_of(lambda: sum(map(is_probably_prime, numbers)), 1, repeat=1)
+        print("  from {:8}  {:8.1f}".format(label, cost * 1e3))
+
+
+def import_times():
+    # Cumulative import time in us of golfish and of each module it imports
+    # directly, from python -X importtime in a fresh interpreter
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import golfish"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+
+    # Modules are listed after everything they import, indented by depth
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.endswith("| package"):
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        if depth == 1:
+            times[name.strip()] = int(cumulative)
+        elif depth == 0 and name.strip() != "golfish":
+            times.clear()
+        elif depth == 0:
+            times["golfish"] = int(cumulative)
+            return times
+
+    return times
+
+
+def bench_startup():
+    print("Import time of golfish and its direct imports, best of 5 (us)")
+    runs = [import_times() for _ in range(5)]
+
+    for name in runs[0]:
+        print("  {:14}  {:8}".format(name, min(run.get(name, 0) for run in runs)))
+
+
+def bench_batch():
+    # Throughput of run_batch on a batch of loop-heavy jobs, by number of
+    # worker processes
+    jobs = [{"code": "0IFLP+|n;", "input": "20000"}] * 64
+    print("Batch of {} jobs (jobs/s)".format(len(jobs)))
+
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        cost = best_of(lambda: list(run_batch(jobs, workers)), 1, repeat=1)
+        print("  {:2} workers      {:8.1f}".format(workers, len(jobs) / cost))
+
+
+def bench_compile():
+    # Sum of 1..n, a tight arithmetic loop which the compiler supports
+    code = "0Iv\n  >:?!v:@+$M\n      >~n;"
+    print("Arithmetic loop, n = 20000 (ms/run)")
+
+    for compiled in [False, True]:
+        def run(compiled=compiled):
+            stdout, sys.stdout = sys.stdout, io.StringIO()
+
+            try:
+                Golfish(code, "20000", online=True, compiled=compiled).run()
+            finally:
+                sys.stdout = stdout
+
+        cost = best_of(run, 1)
+        print("  {:14}  {:8.2f}".format("compiled" if compiled else "interpreted", cost * 1e3))
+
+
+def chain_dispatcher(gf):
+    # A stand-in for the old if/elif handle_normal_instruction: the same
+    # tests in the same order, each branch calling the op's handler
+    lines = ["def handle(instruction):",
+             "    if instruction in gf._variable_map:",
+             "        gf.push_int(gf._variable_map[instruction])",
+             "        return",
+             "    if instruction in gf._function_alias_map:",
+             "        gf.call_alias(instruction)",
+             "        return"]
+
+    for index, chars in enumerate(CHAIN_ORDER):
+        test = "in" if len(chars) > 1 else "=="
+        lines.append("    {}if instruction {} {!r}:".format("el" if index else "", test, chars))
+        lines.append("        table[instruction]()")
+
+    lines.append("    else:")
+    lines.append("        raise NotImplementedError")
+
+    namespace = {"gf": gf, "table": gf._normal_table}
+    exec("\n".join(lines), namespace)
+    return namespace["handle"]
+
+
+def bench_dispatch():
+    # Per-opcode cost of dispatching through the old if/elif chain and
+    # through handle_normal_instruction's table, on a small stack that no
+    # opcode ever empties
+    print("Per-opcode dispatch cost (ns/op)")
+    print("     {:>8}  {:>8}".format("chain", "table"))
+
+    for opcode in DISPATCH_OPCODES:
+        costs = []
+
+        for dispatcher in [chain_dispatcher, lambda gf: gf.handle_normal_instruction]:
+            gf = Golfish("", online=True)
+            handle = dispatcher(gf)
+
+            if opcode == '|':
+                # Keep an if-block open so that | has something to close
+                def op(gf=gf, handle=handle):
+                    gf._bookmark_stack.append(IfBookmark(None, None))
+                    handle('|')
+            else:
+                def op(opcode=opcode, handle=handle):
+                    handle(opcode)
+
+            gf._curr_stack.extend([1] * 1000)
+            costs.append(best_of(op, 20000))
+
+        print("  {}  {:8.1f}  {:8.1f}".format(opcode, *(cost * 1e9 for cost in costs)))
+
+
+def bench_rotate():
+    print("Rotating a stack of n elements with { and } (ns/op)")
+
+    for n in [10**3, 10**5, 10**6]:
+        gf = Golfish("", online=True)
+        gf._curr_stack.extend(range(n))
+
+        cost = best_of(lambda: (gf.op_rotate_left(), gf.op_rotate_right()), 1000)
+        print("  n = {:<8}  {:8.1f}".format(n, cost / 2 * 1e9))
+
+
+def bench_kopy_nth():
+    # k's cost by how far down it reaches, on the deque-backed Stack and,
+    # for comparison, on a plain list. Deque indexing walks blocks in from
+    # the nearer end, so only the middle of a big stack is slow.
+    print("Copying the nth element of a stack of n elements with k (ns/op)")
+    print("  {:10}  {:>8}  {:>8}  {:>8}  {:>8}".format("", "top", "middle", "bottom", "list mid"))
+
+    for n in [10**3, 10**5, 10**6]:
+        costs = []
+
+        for depth in [1, n//2, n-1]:
+            gf = Golfish("", online=True)
+            gf._curr_stack.extend(range(n))
+            costs.append(best_of(lambda: (gf.push_int(depth), gf.op_kopy_nth(), gf.pop()), 1000))
+
+        gf = Golfish("", online=True)
+        gf._curr_stack = list(range(n))
+        costs.append(best_of(lambda: (gf.push_int(n//2), gf.op_kopy_nth(), gf.pop()), 1000))
+
+        print("  n = {:<6}  {:8.1f}  {:8.1f}  {:8.1f}  {:8.1f}".format(n, *(cost * 1e9 for cost in costs)))
+
+
+BENCHMARKS = {"allocations": bench_allocations,
+              "arithmetic": bench_arithmetic,
+              "batch": bench_batch,
+              "dispatch": bench_dispatch,
+              "examples": bench_examples,
+              "kopy": bench_kopy_nth,
+              "compile": bench_compile,
+              "memoize": bench_memoize,
+              "primes": bench_primes,
+              "recursion": bench_recursion,
+              "rotate": bench_rotate,
+              "startup": bench_startup}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        BENCHMARKS[name]()
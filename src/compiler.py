@@ -0,0 +1,362 @@
+"""
+Ahead-of-time compiler from Gol><> to Python
+
+Every reachable interpreter state (x, y, dir, skip, switched) is found by
+walking the board, and straight-line runs of states are emitted as basic
+blocks - closures which return the next block - in generated Python
+source that is then compiled with compile(). Arithmetic and stack
+shuffling are inlined, while anything more involved calls the same op_*
+handler the interpreter would.
+
+Only programs whose control flow is fixed at compile time are supported.
+Anything that jumps (. J t), loops or calls functions (F W Q | B C A), uses
+R, or could change the meaning of a cell (p V A) raises CompileError, and
+the caller should fall back to the interpreter.
+"""
+
+from functools import partial
+
+try:
+    from golfish import (DIGITS, DIRECTION_INDICES, DIRS, ESCAPES, NORMAL_INSTRUCTIONS,
+                         RANDOM_DIRS, REFLECTIONS, SWITCHED_INSTRUCTIONS)
+except ImportError:
+    from .golfish import (DIGITS, DIRECTION_INDICES, DIRS, ESCAPES, NORMAL_INSTRUCTIONS,
+                          RANDOM_DIRS, REFLECTIONS, SWITCHED_INSTRUCTIONS)
+
+FILENAME = "<golfish>"
+MAX_STATES = 100000
+
+
+UNSUPPORTED = set(".ABCFJQRVWptw|")
+STACK_SWITCHING = set("[]uy")
+SWITCHED_STACK_SWITCHING = set("]")
+HALTING = set(";Hh")
+
+POP = "(st.pop() if st else 0)"
+
+# Inlined instructions, as lines of code
+INLINE = {' ': [],
+          ':': ["v = " + POP, "st.append(v)", "st.append(v)"],
+          '~': ["if st: st.pop()"],
+          '$': ["b = " + POP, "a = " + POP, "st.append(b)", "st.append(a)"],
+          '@': ["c = " + POP, "b = " + POP, "a = " + POP,
+                "st.append(b)", "st.append(c)", "st.append(a)"],
+          '(': ["b = " + POP, "a = " + POP, "st.append(1 if a < b else 0)"],
+          ')': ["b = " + POP, "a = " + POP, "st.append(1 if a > b else 0)"],
+          '=': ["b = " + POP, "a = " + POP, "st.append(1 if a == b else 0)"],
+          'z': ["st.append(0 if {} else 1)".format(POP)],
+          'l': ["st.append(len(st))"],
+          'm': ["st.append(-1)"]}
+
+for _char, _op in [('+', "a + b"), ('-', "a - b"), ('*', "a * b"), ('%', "a % b")]:
+    INLINE[_char] = ["b = " + POP, "a = " + POP, "v = " + _op,
+                     "st.append(v if type(v) is int else norm(v))"]
+
+for _char, _op in [('M', "a - 1"), ('P', "a + 1"), ('s', "a + 16")]:
+    INLINE[_char] = ["a = " + POP, "v = " + _op,
+                     "st.append(v if type(v) is int else norm(v))"]
+
+for _value, _char in enumerate(DIGITS):
+    INLINE[_char] = ["st.append({})".format(_value)]
+
+
+class CompileError(Exception):
+    pass
+
+
+def norm(elem):
+    # Same normalisation as Golfish.push
+    if elem == int(elem):
+        elem = int(elem)
+
+    return elem
+
+
+def random_dir(interpreter):
+    # Same random call as the x instruction, as an index into DIRS
+    return interpreter.rng().choice(RANDOM_DIRS)
+
+
+class CompiledProgram():
+    def __init__(self, source, entry, line_map):
+        self.source = source
+        self._entry = entry
+        self._line_map = line_map # line number -> (x, y, switched)
+
+    def run(self, interpreter):
+        # Runs until the program halts by raising HaltProgram (or errors)
+        try:
+            block = self._entry(interpreter, norm, partial(random_dir, interpreter))
+
+            while True:
+                block = block()
+
+        except Exception as e:
+            self.locate(interpreter, e.__traceback__)
+            raise
+
+    def locate(self, interpreter, tb):
+        # Point the interpreter at the cell whose code raised, for errors
+        lineno = None
+
+        while tb is not None:
+            if tb.tb_frame.f_code.co_filename == FILENAME:
+                lineno = tb.tb_lineno
+
+            tb = tb.tb_next
+
+        if lineno in self._line_map:
+            x, y, switched = self._line_map[lineno]
+            interpreter._x, interpreter._y = x, y
+            interpreter._toggled = switched
+
+
+class Compiler():
+    def __init__(self, board):
+        self._board = board
+
+        self._succ = {} # state -> list of successor states
+        self._actions = {} # state -> (x, y, switched, kind, data)
+
+    def compile(self):
+        start = (-1, 0, 0, 0, False)
+        self.explore(start)
+
+        preds = {}
+
+        for state, succs in self._succ.items():
+            for succ in succs:
+                preds[succ] = preds.get(succ, 0) + 1
+
+        leaders = {start}
+
+        for state, succs in self._succ.items():
+            if len(succs) > 1:
+                leaders.update(succs)
+
+        leaders.update(state for state, count in preds.items() if count > 1)
+
+        names = {state: "b{}".format(i) for i, state in enumerate(sorted(leaders, key=repr))}
+
+        self._lines = ["def entry(g, norm, random_dir):"]
+        self._line_map = {}
+
+        for state in sorted(leaders, key=repr):
+            self.emit_block(state, leaders, names)
+
+        self._lines.append("    return {}".format(names[start]))
+
+        source = "\n".join(self._lines) + "\n"
+        namespace = {}
+        exec(compile(source, FILENAME, "exec"), namespace)
+
+        return CompiledProgram(source, namespace["entry"], self._line_map)
+
+    def explore(self, start):
+        todo = [start]
+
+        while todo:
+            state = todo.pop()
+
+            if state in self._succ:
+                continue
+
+            if len(self._succ) >= MAX_STATES:
+                raise CompileError("Too many states")
+
+            action, succs = self.step(state)
+            self._actions[state] = action
+            self._succ[state] = succs
+            todo.extend(succs)
+
+    def step(self, state):
+        # Simulate one tick from state, returning the action taken and the
+        # list of possible successor states
+        x, y, d, skip, switched = state
+        x, y = self._board.advance(x, y, DIRS[d])
+        char = self._board.cell(x, y)
+
+        if char is None:
+            return (x, y, switched, "nop", None), [(x, y, d, skip, switched)]
+
+        if type(char) is not int or not 0 <= char < 0x110000:
+            raise CompileError("Invalid instruction at {},{}".format(x, y))
+
+        instruction = chr(char)
+
+        if instruction == 'S' and not switched:
+            return (x, y, switched, "nop", None), [(x, y, d, skip, True)]
+
+        if skip > 0:
+            return (x, y, switched, "nop", None), [(x, y, d, skip - 1, False)]
+
+        if switched:
+            if instruction == '"':
+                text, (x, y) = self.parse_string(x, y, d, ord('"'))
+                return (x, y, True, "print", text), [(x, y, d, 0, False)]
+
+            if instruction not in SWITCHED_INSTRUCTIONS:
+                raise CompileError("Unsupported instruction S{}".format(instruction))
+
+            kind = "call-switch" if instruction in SWITCHED_STACK_SWITCHING else "call"
+            return (x, y, True, kind, SWITCHED_INSTRUCTIONS[instruction]), [(x, y, d, 0, False)]
+
+        action = (x, y, False, "nop", None)
+
+        if instruction in DIRECTION_INDICES:
+            return action, [(x, y, DIRECTION_INDICES[instruction], 0, False)]
+
+        if instruction in REFLECTIONS:
+            return action, [(x, y, REFLECTIONS[instruction][d], 0, False)]
+
+        if instruction in UNSUPPORTED:
+            raise CompileError("Unsupported instruction {}".format(instruction))
+
+        if instruction == '!':
+            return action, [(x, y, d, 1, False)]
+
+        if instruction in "?qZ":
+            skip = 2 if instruction == 'q' else 1
+            cond = (x, y, False, "pop-cond" if instruction != 'Z' else "pop-zero", None)
+            return cond, [(x, y, d, 0, False), (x, y, d, skip, False)]
+
+        if instruction == 'E':
+            return (x, y, False, "eof-cond", None), [(x, y, d, 0, False), (x, y, d, 1, False)]
+
+        if instruction == 'x':
+            return (x, y, False, "random-dir", None), [(x, y, i, 0, False) for i in range(4)]
+
+        if instruction in "\"'":
+            values, (x, y) = self.parse_string(x, y, d, char)
+            return (x, y, False, "extend", values), [(x, y, d, 0, False)]
+
+        if instruction == '`':
+            x, y = self._board.advance(x, y, DIRS[d])
+            return (x, y, False, "push", self._board.get(x, y)), [(x, y, d, 0, False)]
+
+        if instruction == 'T':
+            return (x, y, False, "teleport-pad", d), [(x, y, d, 0, False)]
+
+        if instruction in INLINE:
+            return (x, y, False, "inline", instruction), [(x, y, d, 0, False)]
+
+        if instruction not in NORMAL_INSTRUCTIONS or instruction == 'S':
+            raise CompileError("Unsupported instruction {}".format(instruction))
+
+        if instruction in HALTING:
+            return (x, y, False, "halt", NORMAL_INSTRUCTIONS[instruction]), []
+
+        kind = "call-switch" if instruction in STACK_SWITCHING else "call"
+        return (x, y, False, kind, NORMAL_INSTRUCTIONS[instruction]), [(x, y, d, 0, False)]
+
+    def parse_string(self, x, y, d, parse_char):
+        # Decode a string literal whose opening quote is at (x, y), as the
+        # interpreter would, returning the values and closing quote position
+        escaped = False
+        values = []
+        seen = set()
+
+        while True:
+            x, y = self._board.advance(x, y, DIRS[d])
+
+            if (x, y, escaped) in seen:
+                raise CompileError("Unterminated string")
+
+            seen.add((x, y, escaped))
+            char = self._board.get(x, y)
+
+            if escaped:
+                if char in ESCAPES or char == parse_char:
+                    values.append(ESCAPES.get(char, char))
+                else:
+                    values.append(ord('`'))
+                    values.append(char)
+
+                escaped = False
+
+            elif char == ord('`'):
+                escaped = True
+
+            elif char == parse_char:
+                return tuple(values), (x, y)
+
+            else:
+                values.append(char)
+
+    def emit(self, line, x, y, switched, indent=2):
+        self._lines.append("    " * indent + line)
+        self._line_map[len(self._lines)] = (x, y, switched)
+
+    def emit_block(self, state, leaders, names):
+        self._lines.append("    def {}():".format(names[state]))
+        self._lines.append("        st = g._curr_stack")
+        ticks = 0
+
+        while True:
+            x, y, switched, kind, data = self._actions[state]
+            succs = self._succ[state]
+            ticks += 1
+
+            if kind == "inline":
+                for line in INLINE[data]:
+                    self.emit(line, x, y, switched)
+
+            elif kind == "call":
+                self.emit("g.{}()".format(data), x, y, switched)
+
+            elif kind == "call-switch":
+                self.emit("g.{}()".format(data), x, y, switched)
+                self.emit("st = g._curr_stack", x, y, switched)
+
+            elif kind == "push":
+                self.emit("g.push({!r})".format(data), x, y, switched)
+
+            elif kind == "extend":
+                if data:
+                    self.emit("st.extend({!r})".format(data), x, y, switched)
+
+            elif kind == "print":
+                if data:
+                    text = "".join(chr(int(c)) for c in data)
+                    self.emit("g.output({!r})".format(text), x, y, switched)
+
+            elif kind == "teleport-pad":
+                self.emit("g._teleport_pos = ({}, {})".format(x, y), x, y, switched)
+                self.emit("g._teleport_dir = {}".format(data), x, y, switched)
+
+            elif kind == "halt":
+                self.emit("g._ticks += {}".format(ticks), x, y, switched)
+                self.emit("g._x, g._y = {}, {}".format(x, y), x, y, switched)
+                self.emit("g.{}()".format(data), x, y, switched)
+                return
+
+            if len(succs) > 1:
+                self.emit("g._ticks += {}".format(ticks), x, y, switched)
+                targets = [names[succ] for succ in succs]
+
+                if kind == "pop-cond":
+                    self.emit("if {}:".format(POP), x, y, switched)
+                elif kind == "pop-zero":
+                    self.emit("if not {}:".format(POP), x, y, switched)
+                elif kind == "eof-cond":
+                    self.emit("if g._eof:", x, y, switched)
+                    self.emit("g.pop()", x, y, switched, indent=3)
+                elif kind == "random-dir":
+                    self.emit("return ({},)[random_dir()]".format(", ".join(targets)), x, y, switched)
+                    return
+
+                self.emit("return {}".format(targets[0]), x, y, switched, indent=3)
+                self.emit("return {}".format(targets[1]), x, y, switched)
+                return
+
+            state = succs[0]
+
+            if state in leaders:
+                self.emit("g._ticks += {}".format(ticks), x, y, switched)
+                self.emit("return {}".format(names[state]), x, y, switched)
+                return
+
+
+def compile_program(board):
+    # Compile a Playfield, raising CompileError if it can't be compiled
+    return Compiler(board).compile()
@@ -1,29 +1,20 @@
 """
 Gol><>, the slightly golfier version of ><>
 
-Requires Python 3 (tested on Python 3.4.2)
+Requires Python 3.5 or later (for run_async)
 
 Version: 0.4.2 (updated 11 Nov 2015)
 """
 
-import argparse
-import codecs
-from collections import defaultdict, namedtuple
+import io
+from collections import OrderedDict, defaultdict, deque
+from functools import partial
+from itertools import islice, repeat, starmap
 import sys
+from time import monotonic
 
-try:
-    from getch import _Getch
-    getch = _Getch()
-except ImportError:
-    # Fail silently, for online interpreter
-    pass
-
-from fractions import gcd
-from functools import reduce
+from math import gcd
 import math
-import operator
-import random
-import traceback
 
 try:
     from library import *
@@ -41,8 +32,187 @@ MIRRORS = {'/': lambda x,y: [-y, -x],
            '\\': lambda x,y: [y, x],
            '#': lambda x,y: [-x, -y]}
 
+# The IP's direction is kept as an index into DIRS
+DIRS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+DIR_INDEX = {dir_: index for index, dir_ in enumerate(DIRS)}
+RIGHT = DIR_INDEX[(1, 0)]
+
+# The direction each arrow sets, and the direction each mirror turns each
+# direction into
+DIRECTION_INDICES = {char: DIR_INDEX[tuple(dir_)] for char, dir_ in DIRECTIONS.items()}
+REFLECTIONS = {char: tuple(DIR_INDEX[tuple(mirror(*dir_))] for dir_ in DIRS)
+               for char, mirror in MIRRORS.items()}
+
+# Choices for x, in the order Random.choice has always picked from
+RANDOM_DIRS = tuple(DIRECTION_INDICES.values())
+
 EOF = -1
 
+# Bookmark kinds. Loops come last, so kind >= FOR_LOOP means any loop.
+FUNCTION_CALL, IF_BLOCK, FOR_LOOP, WHILE_LOOP = range(4)
+
+# Escapes within string literals, besides the quote character itself
+ESCAPES = {ord(a): ord(b) for a,b in zip("`nr","`\n\r")}
+
+# Output flush policies. Output is always flushed on halt and before
+# blocking on stdin, whatever the policy.
+FLUSH_CHAR = "char" # after every write
+FLUSH_LINE = "line" # on newline, or when the buffer is full
+FLUSH_BLOCK = "block" # when the buffer is full
+OUTPUT_BUFFER_SIZE = 8192
+
+INPUT_CHUNK_SIZE = 65536
+
+# How a run ended, as returned by run()
+HALTED = "halted"
+TIMED_OUT = "timeout"
+ERRORED = "error"
+INTERRUPTED = "interrupted"
+
+# How a run with a tick budget paused, see run()
+BUDGET_EXHAUSTED = "budget-exhausted"
+WAITING_FOR_INPUT = "waiting-for-input"
+
+# How a run ended on time_limit or memory_limit, which are checked every
+# LIMIT_CHECK_TICKS ticks (and as often within a long R), see check_limits()
+OUT_OF_TIME = "time-limit"
+OUT_OF_MEMORY = "memory-limit"
+LIMIT_CHECK_TICKS = 4096
+
+# Instructions which leave the IP, skip/switch/repeat state, board and
+# bookmarks alone, so that straight runs of them can be replayed as traces
+TRACEABLE = set(" 0123456789abcdef$%&()*+,-:;=@DHIKLMNPTX[]ghijklmnorsuyz{}~")
+MAX_TRACE_LENGTH = 256
+
+# Instructions which read input. run_async() keeps them out of traces, so
+# that it can stop just before one to await more input.
+INPUT_CHARS = set("iI")
+INPUT_OPS = {ord(char) for char in INPUT_CHARS}
+ASYNC_TRACEABLE = TRACEABLE - INPUT_CHARS
+ASYNC_YIELD_TICKS = 1000
+
+# Instructions which only touch the top of the current stack, so that a
+# function made of nothing else (and calls to other such functions) always
+# leaves the same result for the same consumed stack elements. g is safe as
+# the memo is dropped whenever the board changes. Switched instructions are
+# checked against PURE_SWITCHED.
+PURE = set(" !0123456789abcdef$%'()*+,-:;<=>?@BMPQSXZ\"`gmqsz|~")
+PURE_SWITCHED = set("%&(),23<=>ADLPTlu^|")
+ALIAS_MEMO_SIZE = 65536
+
+# Instruction tables, mapping each char to the name of the Golfish method
+# which implements it. Directions, mirrors, digits and quotes are
+# parameterised and bound separately in build_instruction_tables().
+NORMAL_INSTRUCTIONS = {' ': 'op_nop',
+                       '!': 'op_trampoline',
+                       '$': 'op_swap',
+                       '%': 'op_modulo',
+                       '&': 'op_register',
+                       '(': 'op_less_than',
+                       ')': 'op_greater_than',
+                       '*': 'op_multiply',
+                       '+': 'op_add',
+                       ',': 'op_divide',
+                       '-': 'op_subtract',
+                       '.': 'op_jump',
+                       ':': 'op_duplicate',
+                       ';': 'op_halt',
+                       '=': 'op_equals',
+                       '?': 'op_conditional',
+                       '@': 'op_rotate3',
+                       'A': 'op_alias',
+                       'B': 'op_break',
+                       'C': 'op_continue',
+                       'D': 'op_debug',
+                       'E': 'op_eof_cond',
+                       'F': 'op_for',
+                       'H': 'op_halt_char',
+                       'I': 'op_input_num',
+                       'J': 'op_jump_cond',
+                       'K': 'op_kopy_n',
+                       'L': 'op_loop_counter',
+                       'M': 'op_decrement',
+                       'N': 'op_num_out_nl',
+                       'P': 'op_increment',
+                       'Q': 'op_qmark_any',
+                       'R': 'op_repeat',
+                       'S': 'op_switch',
+                       'T': 'op_teleport_pad',
+                       'V': 'op_var',
+                       'W': 'op_while',
+                       'X': 'op_exponentiate',
+                       'Z': 'op_zero_cond',
+                       '[': 'op_merge_left',
+                       ']': 'op_split_right',
+                       '`': 'op_escape',
+                       'g': 'op_get',
+                       'h': 'op_halt_num',
+                       'i': 'op_input_char',
+                       'j': 'op_closure',
+                       'k': 'op_kopy_nth',
+                       'l': 'op_length',
+                       'm': 'op_push_minus1',
+                       'n': 'op_num_out',
+                       'o': 'op_char_out',
+                       'p': 'op_put',
+                       'q': 'op_qmark2',
+                       'r': 'op_reverse',
+                       's': 'op_sixteen',
+                       't': 'op_teleport',
+                       'u': 'op_stack_right',
+                       'w': 'op_while_marker',
+                       'x': 'op_random_dir',
+                       'y': 'op_stack_left',
+                       'z': 'op_is_zero',
+                       '{': 'op_rotate_left',
+                       '|': 'op_block_end',
+                       '}': 'op_rotate_right',
+                       '~': 'op_discard'}
+
+SWITCHED_INSTRUCTIONS = {'"': 'op_print_string',
+                         '%': 'op_gcd',
+                         '&': 'op_bitwise_and',
+                         '(': 'op_floor',
+                         ')': 'op_ceil',
+                         ',': 'op_int_divide',
+                         '2': 'op_push_e',
+                         '3': 'op_push_pi',
+                         '<': 'op_min',
+                         '=': 'op_round',
+                         '>': 'op_max',
+                         'A': 'op_abs',
+                         'D': 'op_divmod',
+                         'E': 'op_eof_flag',
+                         'L': 'op_log',
+                         'P': 'op_prime',
+                         'T': 'op_trig',
+                         ']': 'op_copy_split_right',
+                         '^': 'op_bitwise_xor',
+                         'l': 'op_lower',
+                         'n': 'op_num_rounding',
+                         'u': 'op_upper',
+                         'x': 'op_random_float',
+                         '|': 'op_bitwise_or'}
+
+
+_getch = None
+
+
+def getch():
+    # Read a keypress from the console. The getch module (and termios with
+    # it) is only loaded the first time, as most runs never need it.
+    global _getch
+
+    if _getch is None:
+        try:
+            from getch import _Getch
+        except ImportError:
+            from .getch import _Getch
+
+        _getch = _Getch()
+
+    return _getch()
+
 
 class HaltProgram(Exception):
     pass
@@ -52,7 +222,26 @@ class InvalidStateException(Exception):
     pass
 
 
+class NeedInput(Exception):
+    # Raised by run_async()'s input instructions when waiting for input
+    pass
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+class MemoryLimitExceeded(MemoryError):
+    pass
+
+
 class Bookmark():
+    # Subclasses set kind to one of the bookmark kinds below, so that the
+    # interpreter can tell them apart without isinstance()
+    __slots__ = ("pos", "dir", "closure_stack")
+
+    kind = None
+
     def __init__(self, pos, dir_, closure_stack):
         self.pos = pos
         self.dir = dir_
@@ -60,6 +249,8 @@ class Bookmark():
 
 
 class LoopBookmark(Bookmark):
+    __slots__ = ("counter",)
+
     def __init__(self, pos, dir_, closure_stack):
         super().__init__(pos, dir_, closure_stack)
         self.counter = 0
@@ -69,70 +260,478 @@ class LoopBookmark(Bookmark):
 
 
 class WhileBookmark(LoopBookmark):
-     def __init__(self, pos, dir_, closure_stack, w_marker=None):
-         super().__init__(pos, dir_, closure_stack)
-         self.w_marker = w_marker
+    __slots__ = ("w_marker",)
+
+    kind = WHILE_LOOP
+
+    def __init__(self, pos, dir_, closure_stack, w_marker=None):
+        super().__init__(pos, dir_, closure_stack)
+        self.w_marker = w_marker
 
 
 class ForBookmark(LoopBookmark):
+    __slots__ = ("limit", "fast")
+
+    kind = FOR_LOOP
+
     def __init__(self, pos, dir_, closure_stack, limit):
         super().__init__(pos, dir_, closure_stack)
         self.limit = limit
+        self.fast = False # run by run_for_loop(), which may have to pick it up again
 
 
 class FunctionBookmark(Bookmark):
-    def __init__(self, pos, dir_, closure_stack):
-        super().__init__(pos, dir_, closure_stack)
+    __slots__ = ()
+
+    kind = FUNCTION_CALL
 
 
 class IfBookmark(Bookmark):
+    __slots__ = ()
+
+    kind = IF_BLOCK
+
     def __init__(self, pos, dir_):
         super().__init__(pos, dir_, None)
 
 
-class Golfish():
-    def __init__(self, code="", input_=None, debug=False, online=False, tick_limit=None):
-        rows = code.split("\n")
-        self._board = defaultdict(lambda: defaultdict(int))
-        x = y = 0
-
-        for char in code:
-            if char == "\n":
-                y += 1
+class Stack(deque):
+    # O(1) at both ends, for rotations. Prints like a list for D.
+    #
+    # Indexing, for k, is O(n) towards the middle of a big stack, where a
+    # list would be O(1). Anything which fixed that (a ring buffer, or a
+    # list with a moving bottom) would have to be written in Python, and
+    # every push and pop would pay for it, while k mostly reaches only a
+    # few elements down. See bench_kopy_nth() in benchmarks.py.
+
+    def __repr__(self):
+        return repr(list(self))
+
+    __str__ = __repr__
+
+    def pop_n(self, n):
+        # Pop the top n elements, returned bottom first. Short stacks are
+        # padded with 0s from below, as if popped from a bottomless stack.
+        count = len(range(n))
+
+        if count >= len(self):
+            elems = [0] * (count - len(self))
+            elems.extend(self)
+            self.clear()
+
+        else:
+            elems = list(starmap(self.pop, repeat((), count)))
+            elems.reverse()
+
+        return elems
+
+
+class CellCache():
+    # Values derived from cells of the board, each dropped as soon as p
+    # writes to any cell it was derived from
+
+    def __init__(self):
+        self._entries = {}
+        self._keys_by_cell = defaultdict(set)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def add(self, key, value, cells):
+        self._entries[key] = value
+
+        for cell in cells:
+            self._keys_by_cell[cell].add(key)
+
+    def invalidate(self, x, y):
+        for key in self._keys_by_cell.pop((x, y), ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_cell.clear()
+
+
+class MemoFrame():
+    # A call to a pure function being recorded for AliasMemo. low is the
+    # lowest the stack has been during the call, and consumed holds the
+    # caller's elements popped on the way down to it, top first.
+    __slots__ = ("bookmark", "alias", "entry", "low", "consumed", "bottomed")
+
+    def __init__(self, bookmark, alias, entry):
+        self.bookmark = bookmark
+        self.alias = alias
+        self.entry = entry
+        self.low = entry
+        self.consumed = []
+        self.bottomed = False # popped from an empty stack
+
+    def absorb(self, entry, low, consumed, bottomed):
+        # Take in a nested call made at depth entry, which consumed the
+        # caller's elements down to low
+        if low < self.low:
+            self.consumed.extend(consumed[entry - self.low:])
+            self.low = low
+
+        self.bottomed = self.bottomed or bottomed
+
+
+class AliasMemo():
+    # LRU cache of results of calls to pure A functions, keyed by the
+    # function and the stack elements each call consumed. Watches the board
+    # like a CellCache, but any change drops everything.
+
+    def __init__(self, size=ALIAS_MEMO_SIZE):
+        self._size = size
+        self._entries = OrderedDict() # (alias, consumed) -> result
+        self._arities = defaultdict(set) # alias -> numbers of elements consumed
+        self._purity = {} # alias -> whether its function is pure
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, alias, stack):
+        # Result of calling alias on stack, as (consumed, result), or None
+        for arity in self._arities[alias]:
+            if arity <= len(stack):
+                consumed = tuple(islice(reversed(stack), arity))[::-1]
+                result = self._entries.get((alias, consumed))
+
+                if result is not None:
+                    self._entries.move_to_end((alias, consumed))
+                    self.hits += 1
+                    return consumed, result
+
+        self.misses += 1
+        return None
+
+    def add(self, alias, consumed, result):
+        self._entries[(alias, consumed)] = result
+        self._arities[alias].add(len(consumed))
+
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def purity(self, alias):
+        return self._purity.get(alias)
+
+    def set_purity(self, alias, pure):
+        self._purity[alias] = pure
+
+    def invalidate(self, x, y):
+        self.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._arities.clear()
+        self._purity.clear()
+
+
+class Playfield():
+    # Cells near the origin are kept in dense rows (None marks an empty cell).
+    # Writes outside that region - negative, non-integral or far-away
+    # coordinates - go to a sparse dict keyed by (x, y) instead.
+
+    MAX_DENSE_GAP = 64
+
+    def __init__(self, code=""):
+        # code is a program as a string, or another Playfield to copy
+        if isinstance(code, Playfield):
+            self._copy(code)
+            return
+
+        self._rows = []
+        self._sparse = {}
+
+        # Extents, kept up to date by set() so that wrapping is O(1)
+        self._row_max = {} # y -> largest x of a filled cell in row y
+        self._max_row = None
+
+        self._caches = []
+        self._written = set() # cells set since the board was made
+
+        for y, line in enumerate(code.split("\n")):
+            self._rows.append([ord(char) for char in line])
+
+            if line:
+                self._row_max[y] = len(line) - 1
+                self._max_row = y
+
+    def _copy(self, other):
+        self._rows = [row.copy() for row in other._rows]
+        self._sparse = other._sparse.copy()
+        self._row_max = other._row_max.copy()
+        self._max_row = other._max_row
+        self._caches = []
+        self._written = other._written.copy()
+
+    def cell(self, x, y):
+        # Fast path for integer coordinates: value at (x, y), or None if empty.
+        # Others, which p can write to, are only ever in the sparse dict.
+        rows = self._rows
+
+        if type(y) is int and 0 <= y < len(rows):
+            row = rows[y]
+
+            if type(x) is int and 0 <= x < len(row):
+                return row[x]
+
+        if self._sparse:
+            return self._sparse.get((x, y))
+
+        return None
+
+    def get(self, x, y):
+        if type(x) is int and type(y) is int:
+            value = self.cell(x, y)
+        else:
+            value = self._sparse.get((x, y))
+
+        return 0 if value is None else value
+
+    def set(self, x, y, value):
+        if self._extend(x, y):
+            # Wrapping may have changed anywhere, so nothing cached is safe
+            for cache in self._caches:
+                cache.clear()
+        else:
+            for cache in self._caches:
+                cache.invalidate(x, y)
+
+        self._written.add((x, y))
+        rows = self._rows
+
+        if type(x) is int and type(y) is int and 0 <= x and 0 <= y < len(rows) + self.MAX_DENSE_GAP:
+            while y >= len(rows):
+                rows.append([])
+
+            row = rows[y]
+
+            if x < len(row):
+                row[x] = value
+                return
+
+            if x < len(row) + self.MAX_DENSE_GAP:
+                self._grow_row(y, x + 1)
+                row[x] = value
+                return
+
+        self._sparse[(x, y)] = value
+
+    def _extend(self, x, y):
+        # Grow the extents to cover (x, y), returning whether they changed
+        changed = False
+
+        if y not in self._row_max or x > self._row_max[y]:
+            self._row_max[y] = x
+            changed = True
+
+        if self._max_row is None or y > self._max_row:
+            self._max_row = y
+            changed = True
+
+        return changed
+
+    def _grow_row(self, y, length):
+        row = self._rows[y]
+        start = len(row)
+        row.extend([None] * (length - start))
+
+        # Pull in any sparse cells now covered by the dense row
+        if self._sparse:
+            for x in range(start, length):
+                if (x, y) in self._sparse:
+                    row[x] = self._sparse.pop((x, y))
+
+    def written(self):
+        # Every cell set since the board was made, as ((x, y), value)
+        return [(cell, self.get(*cell)) for cell in self._written]
+
+    def has_row(self, y):
+        return y in self._row_max
+
+    def row_max(self, y):
+        # Largest x of a filled cell in row y, or None if the row is empty
+        return self._row_max.get(y)
+
+    def max_row(self):
+        return self._max_row
+
+    def advance(self, x, y, dir_):
+        # Position one step from (x, y) in direction dir_, wrapping around.
+        # Coordinates are truncated first, as wrapping can land the IP on a
+        # cell p wrote at non-integer ones.
+        x = int(x) + dir_[0]
+        y = int(y) + dir_[1]
+
+        row_max = self._row_max.get(y)
+
+        if row_max is not None:
+            if dir_[0] == 1 and x > row_max:
                 x = 0
 
-            else:
-                self._board[y][x] = ord(char)
-                x += 1
+            elif dir_[0] == -1 and x < 0:
+                x = row_max
+
+        elif dir_[1] == 1 and y > self._max_row:
+            y = 0
+
+        elif dir_[1] == -1 and y < 0:
+            y = self._max_row
+
+        return x, y
+
+    def watch(self, cache):
+        # Register a CellCache to be invalidated whenever the board changes
+        self._caches.append(cache)
+
+
+def is_binary(stream):
+    return isinstance(stream, (io.RawIOBase, io.BufferedIOBase))
+
+
+def write_text(stream, text):
+    # Write to a text stream, a binary stream as UTF-8 (no TextIOWrapper
+    # in between), or a sink function taking each chunk of text
+    if is_binary(stream):
+        stream.write(text.encode("utf-8"))
+    elif hasattr(stream, "write"):
+        stream.write(text)
+    else:
+        stream(text)
 
-        self._pos = [-1, 0] # [x, y]
-        self._dir = DIRECTIONS[">"]
+
+def flush_stream(stream):
+    flush = getattr(stream, "flush", None)
+
+    if flush is not None:
+        flush()
+
+
+class OutputBuffer():
+    # Output waiting to be written to a stream (see write_text), according
+    # to a flush policy. Without a stream, output goes to whatever
+    # sys.stdout is at the time.
+
+    def __init__(self, policy=None, size=OUTPUT_BUFFER_SIZE, stream=None):
+        if policy is None:
+            isatty = getattr(sys.stdout if stream is None else stream, "isatty", None)
+            policy = FLUSH_LINE if isatty is not None and isatty() else FLUSH_BLOCK
+
+        if policy not in (FLUSH_CHAR, FLUSH_LINE, FLUSH_BLOCK):
+            raise ValueError("Unknown flush policy {!r}".format(policy))
+
+        self._policy = policy
+        self._size = size
+        self._stream = stream
+        self._parts = []
+        self._length = 0
+
+    def write(self, out):
+        self._parts.append(out)
+        self._length += len(out)
+
+        if (self._length >= self._size or self._policy == FLUSH_CHAR
+            or (self._policy == FLUSH_LINE and '\n' in out)):
+
+            self.flush()
+
+    def flush(self):
+        stream = sys.stdout if self._stream is None else self._stream
+
+        if self._parts:
+            write_text(stream, "".join(self._parts))
+            self._parts = []
+            self._length = 0
+
+        flush_stream(stream)
+
+
+class Golfish():
+    def __init__(self, code="", input_=None, debug=False, online=False, tick_limit=None,
+                 compiled=False, flush_policy=None, stream_input=True, memoize_aliases=False,
+                 seed=None, stdout=None, stderr=None, stdin=None, time_limit=None,
+                 memory_limit=None):
+        self._board = Playfield(code)
+        self._traces = CellCache() # (x, y, dir) -> (ops, end), see build_trace()
+        self._traceable = TRACEABLE
+        self._board.watch(self._traces)
+        self._block_ends = CellCache() # (x, y, dir) -> (x, y) of matching |, see to_block_end()
+        self._board.watch(self._block_ends)
+        self._strings = CellCache() # (x, y, dir, quote) -> (chars, end), see lex_string()
+        self._board.watch(self._strings)
+
+        self._x = -1
+        self._y = 0
+        self._dir = RIGHT # index into DIRS
 
         self._ticks = 0
         self._tick_limit = tick_limit
+        self._status = None # once the program has stopped, see run()
+
+        # time_limit is in seconds from the first run(), memory_limit in
+        # elements across the stack tape. tick() and replay() stop at
+        # _stop_tick for either to be checked, see set_stop_tick().
+        self._time_limit = time_limit
+        self._memory_limit = memory_limit
+        self._deadline = None
+        self._stop_tick = None
 
-        self._stack_tape = defaultdict(list)
+        self._stack_tape = defaultdict(Stack)
         self._curr_stack = self._stack_tape[0]
         self._stack_num = 0
         self._register_tape = defaultdict(lambda:None)
 
-        self._input = input_
+        # Input is consumed from self._input through a cursor. Without input_,
+        # it is refilled from stdin as it runs out - in large chunks if
+        # stream_input is set and stdin isn't a terminal.
+        # Bytes are decoded like stdin, as UTF-8 with newlines translated.
+        if isinstance(input_, (bytes, bytearray)):
+            input_ = io.IncrementalNewlineDecoder(None, translate=True).decode(
+                bytes(input_).decode("utf-8"), final=True)
+
+        self._input = input_ or ""
+        self._input_pos = 0
+        self._input_eof = input_ is not None
+        self._stream_input = stream_input
+        self._stdin_decoder = None
+        self._async_input = False # see enable_pausing()
+        self._resume = False # rerun the input instruction under the IP first
+
         self._debug = debug
         self._online = online
+        self._compiled = compiled
+        self._fresh = True # yet to run or be restored, so compiled can start it
         
+        # Streams default to the sys ones, looked up on each use
+        self._stdout = stdout
+        self._stderr = stderr
+        self._stdin = stdin
+
         self._input_buffer = None
+        self._output_buffer = OutputBuffer(flush_policy, stream=stdout)
         self._last_output = '\n'
 
         self._toggled = False # S
         self._skip = 0 # ?! and more
 
-        self._teleport_pos = [-1, 0] # tT
-        self._teleport_dir = DIRECTIONS[">"]
+        self._teleport_pos = (-1, 0) # tT
+        self._teleport_dir = RIGHT
+
+        self._seed = seed
+        self._random = None # x, Sx and SP, see rng()
 
         self._variable_map = {} # V
         self._function_alias_map = {} # A
 
         self._R_repeat = 1 # R
+        self._repeating = False # R with a count other than 1 in progress
 
         self._bookmark_stack = [] # AFQW
         self._marker_stack = []
@@ -140,770 +739,1352 @@ class Golfish():
 
         self._eof = False # E
 
-        self._closure_stack = [] # j
+        self._closure_stack = [] # j
+
+        # Pure A functions have their results cached if memoize_aliases is
+        # set, see call_alias(). Calls being recorded are on _memo_frames.
+        self._alias_memo = None
+        self._memo_frames = []
+
+        if memoize_aliases:
+            self._alias_memo = AliasMemo()
+            self._board.watch(self._alias_memo)
+            self.pop = self.memo_pop
+
+        self.set_stop_tick()
+        self.build_instruction_tables()
+
+    def run(self, max_ticks=None):
+        # Returns how the program ended, one of the run statuses above. With
+        # max_ticks, it may instead pause after that many ticks, returning
+        # BUDGET_EXHAUSTED, or when it needs input beyond what it has been
+        # given, returning WAITING_FOR_INPUT (see feed_input()). Calling
+        # run() again carries on from there.
+        if self._status is not None:
+            return self._status
+
+        budget = None
+
+        if max_ticks is not None:
+            self.enable_pausing()
+            budget = self._ticks + max(max_ticks, 1) - 1
+
+        self.start_clock()
+
+        try:
+            self.set_stop_tick(budget)
+
+            if self._compiled and self._fresh and self._stop_tick is None:
+                program = self.compile()
+
+                if program is not None:
+                    program.run(self)
+
+            self._fresh = False
+
+            while True:
+                try:
+                    if self._resume:
+                        self._resume = False
+                        self.resume_tick()
+
+                    while True:
+                        self.tick()
+
+                except TimeoutError:
+                    if self.checkpoint(budget):
+                        return BUDGET_EXHAUSTED
+
+        except NeedInput:
+            self._resume = True
+            return WAITING_FOR_INPUT
+
+        except (HaltProgram, KeyboardInterrupt, Exception) as e:
+            return self.stopped(e)
+
+        finally:
+            self.set_stop_tick()
+            self._output_buffer.flush()
+
+
+    async def run_async(self, reader=None, yield_every=ASYNC_YIELD_TICKS):
+        # Like run(), but gives the event loop a turn every yield_every
+        # ticks, and awaits input from reader (an asyncio.StreamReader, or
+        # None for no input beyond input_) rather than blocking on stdin
+        import asyncio
+
+        if self._status is not None:
+            return self._status
+
+        self.enable_pausing()
+        self.start_clock()
+        self._fresh = False
+
+        # Each turn is a budget of ticks, like run(max_ticks), so that long
+        # traces and F loops stop on time too
+        budget = self._ticks + max(yield_every, 1) - 1
+
+        try:
+            while True:
+                try:
+                    self.set_stop_tick(budget)
+
+                    if self._resume:
+                        self._resume = False
+                        self.resume_tick()
+
+                    while True:
+                        self.tick()
+
+                except NeedInput:
+                    self._resume = True
+
+                    while not self.feed_input(await reader.read(INPUT_CHUNK_SIZE)
+                                              if reader is not None else ""):
+                        pass
+
+                except TimeoutError:
+                    if self.checkpoint(budget):
+                        await asyncio.sleep(0)
+                        budget = self._ticks + max(yield_every, 1) - 1
+
+        except (HaltProgram, KeyboardInterrupt, Exception) as e:
+            return self.stopped(e)
+
+        finally:
+            self.set_stop_tick()
+            self._output_buffer.flush()
+
+
+    def start_clock(self):
+        # Start the time limit counting down, on the first run
+        if self._time_limit is not None and self._deadline is None:
+            self._deadline = monotonic() + self._time_limit
+
+
+    def set_stop_tick(self, budget=None):
+        # Have tick() and replay() raise TimeoutError after the nearest of
+        # the tick limit, the last tick of the budget and, with a time or
+        # memory limit, the next check of them
+        stops = [stop for stop in (self._tick_limit, budget) if stop is not None]
+
+        if self._time_limit is not None or self._memory_limit is not None:
+            stops.append(self._ticks + LIMIT_CHECK_TICKS - 1)
+
+        self._stop_tick = min(stops) if stops else None
+
+
+    def checkpoint(self, budget=None):
+        # On reaching _stop_tick: raises TimeoutError for the tick limit, or
+        # an error for the time or memory limit, returns True if the budget
+        # is spent, or else returns False with the next stop set
+        if self._tick_limit is not None and self._ticks > self._tick_limit:
+            raise TimeoutError
+
+        if budget is not None and self._ticks > budget:
+            return True
+
+        self.check_limits()
+        self.set_stop_tick(budget)
+        return False
+
+
+    def check_limits(self):
+        if self._deadline is not None and monotonic() > self._deadline:
+            raise TimeLimitExceeded
+
+        if self._memory_limit is not None and self.stack_size() > self._memory_limit:
+            raise MemoryLimitExceeded
+
+
+    def stack_size(self):
+        # Elements across the stack tape, and the current stack if it is off it
+        size = sum(map(len, self._stack_tape.values()))
+
+        if self._curr_stack is not self._stack_tape.get(self._stack_num):
+            size += len(self._curr_stack)
+
+        return size
+
+
+    def reserve(self, n, copies):
+        # Before an instruction pops n elements (padding with 0s) and pushes
+        # them back copies times, check that the stack tape would stay within
+        # the memory limit. Such instructions grow the stacks by any amount
+        # in one tick, so waiting for the next check_limits() won't do.
+        count = len(range(n))
+        growth = (copies - 1)*count + max(count - len(self._curr_stack), 0)
+
+        if growth > 0 and self.stack_size() + growth > self._memory_limit:
+            raise MemoryLimitExceeded
+
+
+    def enable_pausing(self):
+        # Make reading past the input given raise NeedInput rather than
+        # block, with input instructions kept out of traces so that they
+        # can be undone and run again, see handle_instruction_async()
+        if not self._async_input:
+            self._async_input = True
+            self._traceable = ASYNC_TRACEABLE
+            self._traces.clear()
+            self.handle_instruction = self.handle_instruction_async
+
+
+    def feed_input(self, data):
+        # Give a paused program more input, as str or UTF-8 bytes. Empty data
+        # means EOF. Returns whether there is anything new for the program
+        # to read, which is not the case for part of a UTF-8 sequence.
+        if not data:
+            self._input_eof = True
+            return True
+
+        if isinstance(data, (bytes, bytearray)):
+            if self._stdin_decoder is None:
+                import codecs
+                self._stdin_decoder = io.IncrementalNewlineDecoder(
+                    codecs.getincrementaldecoder("utf-8")(), translate=True)
+
+            data = self._stdin_decoder.decode(data)
+
+        if data:
+            self._input = self._input[self._input_pos:] + data
+            self._input_pos = 0
+
+        return bool(data)
+
+
+    def snapshot(self):
+        # The interpreter's state as compressed bytes, for restore() on a
+        # new Golfish made from the same program, maybe in another process.
+        # Cached results are left out, to be rebuilt as needed.
+        import pickle
+        import zlib
+
+        self._output_buffer.flush()
+
+        bookmarks = []
+
+        for bookmark in self._bookmark_stack:
+            state = [bookmark.kind, bookmark.pos, bookmark.dir, bookmark.closure_stack]
+
+            if bookmark.kind >= FOR_LOOP:
+                state.append(bookmark.counter)
+                state.append(bookmark.limit if bookmark.kind == FOR_LOOP else bookmark.w_marker)
+
+            bookmarks.append(state)
+
+        state = {"board": self._board.written(),
+                 "ip": (self._x, self._y, self._dir),
+                 "ticks": self._ticks,
+                 "status": self._status,
+                 "stacks": {num: list(stack) for num, stack in self._stack_tape.items() if stack},
+                 "stack_num": self._stack_num,
+                 # 0R on a string leaves the current stack off the tape
+                 "curr_stack": (None if self._curr_stack is self._stack_tape.get(self._stack_num)
+                                else list(self._curr_stack)),
+                 "registers": {num: elem for num, elem in self._register_tape.items()
+                               if elem is not None},
+                 "input": (self._input[self._input_pos:], self._input_eof, self._input_buffer,
+                           self._eof, self._resume),
+                 "last_output": self._last_output,
+                 "toggled": self._toggled,
+                 "skip": self._skip,
+                 "teleport": (self._teleport_pos, self._teleport_dir),
+                 "variables": self._variable_map,
+                 "aliases": self._function_alias_map,
+                 "R_repeat": self._R_repeat,
+                 "bookmarks": bookmarks,
+                 "markers": self._marker_stack,
+                 "last_loop_counter": self._last_loop_counter,
+                 "closure_stack": self._closure_stack,
+                 "random": None if self._random is None else self._random.getstate()}
+
+        return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+
+    def restore(self, snapshot):
+        # Pick up from a snapshot(). Only meant for an interpreter which is
+        # yet to run, made from the same program.
+        import pickle
+        import zlib
+
+        state = pickle.loads(zlib.decompress(snapshot))
+        self._fresh = False
+
+        for (x, y), value in state["board"]:
+            self._board.set(x, y, value)
+
+        self._x, self._y, self._dir = state["ip"]
+        self._ticks = state["ticks"]
+        self._status = state["status"]
+
+        for num, stack in state["stacks"].items():
+            self._stack_tape[num].extend(stack)
+
+        self._stack_num = state["stack_num"]
+
+        if state["curr_stack"] is None:
+            self._curr_stack = self._stack_tape[self._stack_num]
+        else:
+            self._curr_stack = Stack(state["curr_stack"])
+        self._register_tape.update(state["registers"])
+
+        (self._input, self._input_eof, self._input_buffer,
+         self._eof, self._resume) = state["input"]
+        self._input_pos = 0
+
+        if self._resume:
+            self.enable_pausing()
+
+        self._last_output = state["last_output"]
+        self._toggled = state["toggled"]
+        self._skip = state["skip"]
+        self._teleport_pos, self._teleport_dir = state["teleport"]
+        self._variable_map = state["variables"]
+        self._function_alias_map = state["aliases"]
+        self._R_repeat = state["R_repeat"]
+        self._bookmark_stack = [self.restore_bookmark(*bookmark) for bookmark in state["bookmarks"]]
+        self._marker_stack = state["markers"]
+        self._last_loop_counter = state["last_loop_counter"]
+        self._closure_stack = state["closure_stack"]
+
+        if state["random"] is not None:
+            self.rng().setstate(state["random"])
+
+        # Whatever was cached for the program as it was made no longer holds
+        for cache in [self._traces, self._block_ends, self._strings, self._alias_memo]:
+            if cache is not None:
+                cache.clear()
+
+
+    def restore_bookmark(self, kind, pos, dir_, closure_stack, counter=0, extra=None):
+        if kind == FUNCTION_CALL:
+            return FunctionBookmark(pos, dir_, closure_stack)
+
+        if kind == IF_BLOCK:
+            return IfBookmark(pos, dir_)
+
+        if kind == FOR_LOOP:
+            bookmark = ForBookmark(pos, dir_, closure_stack, extra)
+            bookmark.fast = True # op_for() checks the body before using it
+        else:
+            bookmark = WhileBookmark(pos, dir_, closure_stack, extra)
+
+        bookmark.counter = counter
+        return bookmark
+
+
+    def stopped(self, e):
+        # Report why the program stopped, returning the run status, which is
+        # also what any later call to run() returns
+        if isinstance(e, HaltProgram):
+            self._status = HALTED
+            return HALTED
+
+        if isinstance(e, KeyboardInterrupt):
+            self._status = INTERRUPTED
+            self._output_buffer.flush()
+            write_text(self.stream("stderr"), "^C\n")
+
+        elif isinstance(e, (TimeoutError, TimeLimitExceeded, MemoryError)):
+            if isinstance(e, TimeoutError):
+                self._status, message = TIMED_OUT, "[Timeout]"
+            elif isinstance(e, TimeLimitExceeded):
+                self._status, message = OUT_OF_TIME, "[Time limit]"
+            else:
+                self._status, message = OUT_OF_MEMORY, "[Memory limit]"
+
+            if self._last_output not in "\n\r":
+                self.print_error('\n', end='')
+                
+            self.print_error(message)
+
+        else:
+            self._status = ERRORED
+            x, y = self._x, self._y
+            char = self._board.get(x, y)
+
+            if self._last_output not in "\n\r":
+                self.print_error('\n', end='')
+
+            self.print_error("something smells fishy... ", end='')
+
+            if char in range(32, 127):
+                self.print_error("(instruction {} '{}' at {},{})".format(char, "S"*self._toggled + chr(char), x, y))
+            else:
+                self.print_error("(instruction {} at {},{})".format(char, x, y))
+
+        self.traceback(e)
+        return self._status
+
+
+    def compile(self):
+        # Compiled version of the program, or None if it can't be compiled
+        try:
+            from compiler import CompileError, compile_program
+        except ImportError:
+            from .compiler import CompileError, compile_program
+
+        try:
+            return compile_program(self._board)
+        except CompileError:
+            return None
+
+
+    def tick(self):
+        self.move()
+
+        if not self._skip and not self._toggled and self._R_repeat == 1:
+            ops, end = self.trace(self._x, self._y, self._dir)
+
+            if ops:
+                self.replay(ops)
+
+                if end is None:
+                    return
+
+                self._x, self._y = end
+
+        char = self._board.cell(self._x, self._y)
+
+        if char is not None:
+            self.handle_instruction(char)
+
+        self._ticks += 1
+
+        if self._stop_tick is not None and self._ticks > self._stop_tick:
+            raise TimeoutError
+
+
+    def resume_tick(self):
+        # Finish a tick which stopped for NeedInput, by running the input
+        # instruction under the IP again now that there is more input
+        self.handle_instruction(self._board.cell(self._x, self._y))
+        self._ticks += 1
+
+        if self._stop_tick is not None and self._ticks > self._stop_tick:
+            raise TimeoutError
+
+
+    def trace(self, x, y, dir_index):
+        key = (x, y, dir_index)
+        trace = self._traces.get(key)
+
+        if trace is None:
+            trace = self.build_trace(*key)
+
+        return trace
+
+
+    def build_trace(self, x, y, dir_index):
+        # Follow the IP from (x, y) for as long as it only meets traceable
+        # instructions and empty cells, prebinding each cell's handler. The
+        # trace is (ops, end), where ops is a tuple of (x, y, handler) and
+        # end is the position of the instruction that stopped the trace, to
+        # be executed normally, or None.
+        start = (x, y)
+        dir_ = DIRS[dir_index]
+        ops = []
+        cells = []
+        end = None
+
+        while len(ops) < MAX_TRACE_LENGTH:
+            cells.append((x, y))
+            char = self._board.cell(x, y)
+
+            if char is None:
+                ops.append((x, y, None))
+
+            else:
+                instruction = chr(char) if type(char) is int and 0 <= char < 0x110000 else None
+
+                if (instruction not in self._traceable or instruction in self._variable_map
+                    or instruction in self._function_alias_map):
+
+                    end = (x, y)
+                    break
+
+                ops.append((x, y, self._normal_table[instruction]))
+
+            x, y = self._board.advance(x, y, dir_)
+
+            if (x, y) == start:
+                break
+
+        trace = (tuple(ops), end)
+        self._traces.add((start[0], start[1], dir_index), trace, cells)
+        return trace
+
+
+    def replay(self, trace):
+        # Equivalent to one tick() per op, with no need to decode each cell
+        tick_limit = self._stop_tick
+
+        for x, y, handler in trace:
+            self._x = x
+            self._y = y
+
+            if handler is not None:
+                handler()
+
+            self._ticks += 1
+
+            if tick_limit is not None and self._ticks > tick_limit:
+                raise TimeoutError
+
+
+    def move(self):
+        # Move forward one step, wrapping around
+        self._x, self._y = self._board.advance(self._x, self._y, DIRS[self._dir])
+
+
+    def pos_before(self):
+        dx, dy = DIRS[self._dir]
+        return (self._x - dx, self._y - dy)
+    
+
+    def handle_instruction(self, char):
+        instruction = chr(char)
+
+        if instruction == "S" and not self._toggled:
+            self._toggled = True
+            return
+
+        if self._skip > 0:
+            self._skip -= 1
+            self._toggled = False
+            return
+
+        elif self._skip < 0:
+            self._skip = 0
+
+        tmp_R_repeat, self._R_repeat = int(self._R_repeat), 1
+        
+        if self._toggled:
+            self.repeat_instruction(self.handle_switched_instruction, instruction, tmp_R_repeat)
+            self._toggled = False
+
+        else:
+            if tmp_R_repeat > 0:
+                self.repeat_instruction(self.handle_normal_instruction, instruction, tmp_R_repeat)
+
+            else:
+                # Special cases for 0R
+                if instruction in "'\"`":
+                    tmp_stack = self._curr_stack.copy()
+                    self.handle_normal_instruction(instruction)
+                    self._curr_stack = tmp_stack
+
+
+    def handle_instruction_async(self, char):
+        # handle_instruction, for run_async(). An input instruction which
+        # runs out of input is undone before NeedInput reaches run_async(),
+        # so that it can be run again once more input has arrived.
+        if char not in INPUT_OPS:
+            Golfish.handle_instruction(self, char)
+            return
+
+        stack = self._curr_stack
+        state = (self._skip, self._toggled, self._R_repeat, self._eof, len(stack),
+                 self._input, self._input_pos, self._input_buffer)
+
+        try:
+            Golfish.handle_instruction(self, char)
+
+        except NeedInput:
+            (self._skip, self._toggled, self._R_repeat, self._eof, depth,
+             self._input, self._input_pos, self._input_buffer) = state
+
+            while len(stack) > depth:
+                stack.pop()
+
+            raise
+
+
+    def repeat_instruction(self, handler, instruction, count):
+        # Run an instruction count times, each from the same position
+        if count == 1:
+            handler(instruction)
+            return
+
+        x, y = self._x, self._y
+        limited = self._time_limit is not None or self._memory_limit is not None
+        self._repeating = True
+
+        try:
+            for i in range(count):
+                if limited and i % LIMIT_CHECK_TICKS == 0:
+                    self.check_limits()
+
+                self._x, self._y = x, y
+                handler(instruction)
+
+        finally:
+            self._repeating = False
+
+
+    def build_instruction_tables(self):
+        self._normal_table = {char: getattr(self, name)
+                              for char, name in NORMAL_INSTRUCTIONS.items()}
+
+        for char, dir_index in DIRECTION_INDICES.items():
+            self._normal_table[char] = partial(self.op_set_dir, dir_index)
+
+        for char, reflection in REFLECTIONS.items():
+            self._normal_table[char] = partial(self.op_mirror, reflection)
+
+        for value, char in enumerate(DIGITS):
+            self._normal_table[char] = partial(self.push_int, value)
+
+        for char in '"\'':
+            self._normal_table[char] = partial(self.op_string, ord(char))
+
+        self._switched_table = {char: getattr(self, name)
+                                for char, name in SWITCHED_INSTRUCTIONS.items()}
+
+
+    def handle_normal_instruction(self, instruction):
+        if instruction in self._variable_map:
+            self.push_int(self._variable_map[instruction])
+            return
+
+        if instruction in self._function_alias_map:
+            self.call_alias(instruction)
+            return
+
+        handler = self._normal_table.get(instruction)
+
+        if handler is None:
+            raise NotImplementedError
+
+        handler()
+
+
+    def handle_switched_instruction(self, instruction):
+        handler = self._switched_table.get(instruction)
+
+        if handler is None:
+            raise NotImplementedError
+
+        handler()
+
+
+    def call_alias(self, instruction):
+        y, c = self._function_alias_map[instruction]
+        frame = None
+
+        if (self._alias_memo is not None and not self._repeating
+            and self.is_pure_alias(instruction)):
+
+            if self.replay_alias(instruction):
+                return
+
+            frame = MemoFrame(None, instruction, len(self._curr_stack))
+
+        bookmark = FunctionBookmark((self._x, self._y), self._dir, c)
+        self._bookmark_stack.append(bookmark)
+        self._x, self._y = -1, y
+        self._dir = RIGHT
+        self._curr_stack.extend(c[::-1])
+
+        if frame is not None:
+            frame.bookmark = bookmark
+            self._memo_frames.append(frame)
+
+
+    def is_pure_alias(self, alias, seen=None):
+        # Whether every instruction on alias's function row is pure, with
+        # calls to other aliases pure if their functions are. Recursive calls
+        # are assumed pure until shown otherwise.
+        pure = self._alias_memo.purity(alias)
+
+        if pure is not None:
+            return pure
+
+        top = seen is None
+
+        if top:
+            seen = set()
+        elif alias in seen:
+            return True
+
+        seen.add(alias)
+        y = self._function_alias_map[alias][0]
+        row_max = self._board.row_max(y) if type(y) is int else None
+        pure = row_max is not None
+        switched = False
+
+        for x in range(row_max + 1 if pure else 0):
+            char = self._board.cell(x, y)
+
+            if char is None:
+                continue
+
+            instruction = chr(char) if type(char) is int and 0 <= char < 0x110000 else None
+
+            if switched:
+                pure = instruction in PURE_SWITCHED
+                switched = False
+
+            elif instruction in self._variable_map:
+                pass
 
-    def run(self):        
-        try:
-            while True:
-                self.tick()
+            elif instruction in self._function_alias_map:
+                pure = self.is_pure_alias(instruction, seen)
 
-        except HaltProgram:
-            pass
-        
-        except KeyboardInterrupt as e:    
-            print("^C", file=sys.stderr)
-            self.traceback(e)
+            else:
+                pure = instruction in PURE
+                switched = instruction == 'S'
 
-        except TimeoutError as e:
-            if self._last_output not in "\n\r":
-                self.print_error('\n', end='')
-                
-            self.print_error("[Timeout]")
-            self.traceback(e)
+            if not pure:
+                break
 
-        except Exception as e:
-            pos = self._pos
-            char = self._board[pos[1]][pos[0]]
+        if switched:
+            pure = False
 
-            if self._last_output not in "\n\r":
-                self.print_error('\n', end='')
+        # Only the outermost answer is final, as the others may rest on an
+        # assumption about a recursive call
+        if top or not pure:
+            self._alias_memo.set_purity(alias, pure)
 
-            self.print_error("something smells fishy... ", end='')
+        return pure
 
-            if char in range(32, 127):
-                self.print_error("(instruction {} '{}' at {},{})".format(char, "S"*self._toggled + chr(char), pos[0], pos[1]))
-            else:
-                self.print_error("(instruction {} at {},{})".format(char, pos[0], pos[1]))
 
-            self.traceback(e)
+    def replay_alias(self, alias):
+        # Apply a cached result of calling alias to the stack, if there is
+        # one, returning whether there was
+        cached = self._alias_memo.lookup(alias, self._curr_stack)
 
+        if cached is None:
+            return False
 
-    def tick(self):
-        self.move()
+        consumed, result = cached
+        stack = self._curr_stack
+        entry = len(stack)
 
-        if self._pos[1] in self._board and self._pos[0] in self._board[self._pos[1]]:
-            self.handle_instruction(self._board[self._pos[1]][self._pos[0]])
+        for _ in consumed:
+            stack.pop()
 
-        self._ticks += 1
+        stack.extend(result)
 
-        if self._tick_limit is not None and self._ticks > self._tick_limit:
-            raise TimeoutError
+        if self._memo_frames:
+            self._memo_frames[-1].absorb(entry, entry - len(consumed),
+                                         consumed[::-1], False)
 
+        return True
 
-    def move(self):
-        # Move forward one step
-        self._pos[0] = int(self._pos[0]) + self._dir[0]
-        self._pos[1] = int(self._pos[1]) + self._dir[1]
 
-        # Wrap around
-        if self._pos[1] in self._board:
-            if self._dir == DIRECTIONS['>'] and self._pos[0] > max(self._board[self._pos[1]].keys()):
-                self._pos[0] = 0
+    def end_memo_frame(self):
+        # Cache the result of the pure call that has just returned
+        frame = self._memo_frames.pop()
+        stack = self._curr_stack
+        consumed = frame.consumed
 
-            elif self._dir == DIRECTIONS['<'] and self._pos[0] < 0:
-                self._pos[0] = max(self._board[self._pos[1]].keys())
+        if not frame.bottomed:
+            result = tuple(islice(reversed(stack), len(stack) - frame.low))[::-1]
+            self._alias_memo.add(frame.alias, tuple(consumed[::-1]), result)
 
-        elif self._dir == DIRECTIONS['v'] and self._pos[1] > max(self._board.keys()):
-            self._pos[1] = 0
-        
-        elif self._dir == DIRECTIONS['^'] and self._pos[1] < 0:
-            self._pos[1] = max(self._board.keys())
+        if self._memo_frames:
+            self._memo_frames[-1].absorb(frame.entry, frame.low, consumed,
+                                         frame.bottomed)
 
 
-    def pos_before(self):
-        return [self._pos[0] - self._dir[0], self._pos[1] - self._dir[1]]
-    
+    # Normal instructions
 
-    def handle_instruction(self, char):
-        instruction = chr(char)
+    def op_set_dir(self, dir_index):
+        self._dir = dir_index
 
-        if instruction == "S" and not self._toggled:
-            self._toggled = True
-            return
+    def op_mirror(self, reflection):
+        self._dir = reflection[self._dir]
 
-        if self._skip > 0:
-            self._skip -= 1
-            self._toggled = False
-            return
+    def op_nop(self):
+        pass
 
-        elif self._skip < 0:
-            self._skip = 0
+    def op_trampoline(self):
+        self._skip += 1
 
-        tmp_R_repeat, self._R_repeat = int(self._R_repeat), 1
-        tmp_pos = self._pos[:]
-        
-        if self._toggled:
-            for _ in range(tmp_R_repeat):
-                self._pos = tmp_pos[:]
-                self.handle_switched_instruction(instruction)
-                
-            self._toggled = False
+    def op_string(self, parse_char):
+        chars, end = self.string_literal(parse_char)
 
-        else:
-            if tmp_R_repeat > 0:
-                for _ in range(tmp_R_repeat):
-                    self._pos = tmp_pos[:]
-                    self.handle_normal_instruction(instruction)
+        self._x, self._y = end
+        self._curr_stack.extend(chars)
 
-            else:
-                # Special cases for 0R
-                if instruction in "'\"`":
-                    tmp_stack = self._curr_stack[:]
-                    self.handle_normal_instruction(instruction)
-                    self._curr_stack = tmp_stack
+    def op_swap(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
+        self.push_int(elem2)
+        self.push_int(elem1)
 
-    def handle_normal_instruction(self, instruction):
-        if instruction in self._variable_map:
-            self.push(self._variable_map[instruction])
-            return
+    def op_modulo(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        if instruction in self._function_alias_map:
-            y, c = self._function_alias_map[instruction]
-            
-            bookmark = FunctionBookmark(self._pos[:], self._dir[:], c)
-            self._bookmark_stack.append(bookmark)
-            self._pos = [-1, y]
-            self._dir = [1, 0]
-            self._curr_stack.extend(c[::-1])
-            return
+        self.push(elem1 % elem2)
 
-        if instruction in DIRECTIONS:
-            self._dir = DIRECTIONS[instruction]
+    def op_register(self):
+        if self._register_tape[self._stack_num] is None:
+            self._register_tape[self._stack_num] = self.pop()
 
-        elif instruction in MIRRORS:
-            self._dir = MIRRORS[instruction](*self._dir)
+        else:
+            self.push_int(self._register_tape[self._stack_num])
+            self._register_tape[self._stack_num] = None
 
-        elif instruction in DIGITS:
-            self.push(DIGITS.index(instruction))
+    def op_less_than(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == ' ':
-            pass
+        self.push_int(1 if elem1 < elem2 else 0)
 
-        elif instruction == '!':
-            self._skip += 1
+    def op_greater_than(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction in '"\'':
-            escaped = False
-            parse_char = ord(instruction)
-            parse_buffer = []
+        self.push_int(1 if elem1 > elem2 else 0)
 
-            self.move()
-            char = self._board[self._pos[1]][self._pos[0]]
-            
-            while escaped or char != parse_char:
-                if escaped:
-                    escapes = {ord(a): ord(b) for a,b in zip("`nr","`\n\r")}
-                    escapes.update({parse_char: parse_char})
-                    
-                    if char in escapes:
-                        parse_buffer.append(escapes[char])
+    def op_multiply(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-                    else:
-                        parse_buffer.append(ord('`'))
-                        parse_buffer.append(char)
+        self.push(elem1 * elem2)
 
-                    escaped = False
+    def op_add(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-                else:
-                    if char == ord('`'):
-                        escaped = True
-                    else:
-                        parse_buffer.append(char)
+        self.push(elem1 + elem2)
 
-                self.move()
-                char = self._board[self._pos[1]][self._pos[0]]
+    def op_divide(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-            self._curr_stack.extend(parse_buffer)
+        self.push(elem1 / elem2)
 
-        elif instruction == '$':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_subtract(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-            self.push(elem2)
-            self.push(elem1)
-            
-        elif instruction == '%':
-            elem2 = self.pop()
-            elem1 = self.pop()
+        self.push(elem1 - elem2)
 
-            self.push(elem1 % elem2)
+    def op_jump(self):
+        y = self.pop()
+        x = self.pop()
 
-        elif instruction == '&':
-            if self._register_tape[self._stack_num] is None:
-                self._register_tape[self._stack_num] = self.pop()
+        self._x, self._y = int(x), int(y)
 
-            else:
-                self.push(self._register_tape[self._stack_num])
-                self._register_tape[self._stack_num] = None
+    def op_duplicate(self):
+        elem = self.pop()
 
-        elif instruction == '(':
-            elem2 = self.pop()
-            elem1 = self.pop()
+        self.push_int(elem)
+        self.push_int(elem)
 
-            self.push(1 if elem1 < elem2 else 0)
+    def op_halt(self):
+        self.halt()
 
-        elif instruction == ')':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_equals(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-            self.push(1 if elem1 > elem2 else 0)
+        self.push_int(1 if elem1 == elem2 else 0)
 
-        elif instruction == '*':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_conditional(self):
+        condition = self.pop()
 
-            self.push(elem1 * elem2)
+        if not condition:
+            self._skip = 1
 
-        elif instruction == '+':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_rotate3(self):
+        elem3 = self.pop()
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-            self.push(elem1 + elem2)
+        self.push_int(elem2)
+        self.push_int(elem3)
+        self.push_int(elem1)
 
-        elif instruction == ',':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_alias(self):
+        self.move()
+        char = self.char(num=False)
 
-            self.push(elem1 / elem2)
+        y = self.pop()
+        self._function_alias_map[char] = [y, self._closure_stack]
+        self._closure_stack = []
+        self.redefined(char)
 
-        elif instruction == '-':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_break(self):
+        if self._bookmark_stack:
+            self.bookmark_break()
+        else:
+            raise InvalidStateException("Break from non-loop/function")
 
-            self.push(elem1 - elem2)
+    def op_continue(self):
+        while self._bookmark_stack and self._bookmark_stack[-1].kind == IF_BLOCK:
+            self._bookmark_stack.pop()
 
-        elif instruction == '.':
-            y = self.pop()
-            x = self.pop()
+        if self._bookmark_stack and self._bookmark_stack[-1].kind >= FOR_LOOP:
+            bookmark = self._bookmark_stack[-1]
+            self._x, self._y = bookmark.pos
+            self._dir = bookmark.dir
 
-            self._pos = [x, y]
+            if bookmark.kind == WHILE_LOOP and bookmark.w_marker:
+                    (self._x, self._y), self._dir = bookmark.w_marker
 
-        elif instruction == ':':
-            elem = self.pop()
+        else:
+            raise InvalidStateException("Continue from non-loop")
 
-            self.push(elem)
-            self.push(elem)
-            
-        elif instruction == ';':
-            self.halt()
+    def op_debug(self):
+        if self._last_output not in "\n\r":
+            self.output('\n')
 
-        elif instruction == '=':
-            elem2 = self.pop()
-            elem1 = self.pop()
+        self.output(str(self._curr_stack).replace(',', '') + '\n')
 
-            self.push(1 if elem1 == elem2 else 0)
+    def op_eof_cond(self):
+        if self._eof:
+            self.pop()
+        else:
+            self._skip = 1
 
-        elif instruction == '?':
-            condition = self.pop()
+    def op_for(self):
+        if self._bookmark_stack and self._bookmark_stack[-1].pos == self.pos_before():
+            bookmark = self._bookmark_stack[-1]
+            bookmark.increment_counter()
+            self._last_loop_counter = bookmark.counter
 
-            if not condition:
-                self._skip = 1
+            # Back from running an iteration tick by tick up to a stop tick
+            if bookmark.fast and not self._repeating and bookmark.counter < bookmark.limit:
+                body = self.loop_body()
 
-        elif instruction == '@':
-            elem3 = self.pop()
-            elem2 = self.pop()
-            elem1 = self.pop()
+                if body is not None:
+                    self.run_for_loop(bookmark, body)
+                    return
 
-            self.push(elem2)
-            self.push(elem3)
-            self.push(elem1)
+        else:
+            limit = self.pop()
 
-        elif instruction == 'A':
-            self.move()
-            char = self.char(num=False)
+            bookmark = ForBookmark(self.pos_before(), self._dir,
+                                   self._closure_stack, limit)
 
-            y = self.pop()
-            self._function_alias_map[char] = [y, self._closure_stack]
+            self._bookmark_stack.append(bookmark)
             self._closure_stack = []
 
-        elif instruction == 'B':
-            if self._bookmark_stack:
-                self.bookmark_break()
-            else:
-                raise InvalidStateException("Break from non-loop/function")
+            if not self._repeating:
+                body = self.loop_body()
 
-        elif instruction == 'C':
-            while self._bookmark_stack and isinstance(self._bookmark_stack[-1], IfBookmark):
-                self._bookmark_stack.pop()
+                if body is not None:
+                    self.run_for_loop(bookmark, body)
+                    return
 
-            if self._bookmark_stack and isinstance(self._bookmark_stack[-1], LoopBookmark):
-                bookmark = self._bookmark_stack[-1]
-                self._pos = bookmark.pos[:]
-                self._dir = bookmark.dir[:]
+        if (self._bookmark_stack and
+            self._bookmark_stack[-1].counter >= self._bookmark_stack[-1].limit):
 
-                if isinstance(bookmark, WhileBookmark) and bookmark.w_marker:
-                        self._pos = bookmark.w_marker[0][:]
-                        self._dir = bookmark.w_marker[1][:]
+            self.bookmark_break()
+        else:
+            self._curr_stack.extend(self._bookmark_stack[-1].closure_stack)
 
-            else:
-                raise InvalidStateException("Continue from non-loop")
+    def op_halt_char(self):
+        while self._curr_stack:
+            elem = self.pop()
+            self.output_as_char(elem)
 
-        elif instruction == 'D':
-            if self._last_output not in "\n\r":
-                self.output('\n')
+        self.halt()
 
-            self.output(str(self._curr_stack).replace(',', '') + '\n')
+    def op_input_num(self):
+        num = ""
+        char = self.read_char()
 
-        elif instruction == 'E':
-            if self._eof:
-                self.pop()
-            else:
-                self._skip = 1
+        while char >= 0 and chr(char) not in "-0123456789.":
+            char = self.read_char()
 
-        elif instruction == 'F':
-            if self._bookmark_stack and self._bookmark_stack[-1].pos == self.pos_before():
-                self._bookmark_stack[-1].increment_counter()
-                self._last_loop_counter = self._bookmark_stack[-1].counter
-                
-            else:
-                limit = self.pop()
-                
-                bookmark = ForBookmark(self.pos_before(), self._dir[:],
-                                       self._closure_stack, limit)
+        while char >= 0 and chr(char) in "-0123456789.":
+            if chr(char) == '.' and '.' in num:
+                break
 
-                self._bookmark_stack.append(bookmark)
-                self._closure_stack = []
+            if chr(char) == '-' and num:
+                break
 
-            if (self._bookmark_stack and
-                self._bookmark_stack[-1].counter >= self._bookmark_stack[-1].limit):
+            num += chr(char)
+            char = self.read_char()
 
-                self.bookmark_break()
-            else:
-                self._curr_stack.extend(self._bookmark_stack[-1].closure_stack)
+        self._input_buffer = char
 
-        elif instruction == 'H':
-            while self._curr_stack:
-                elem = self.pop()
-                self.output_as_char(elem)
+        if num:
+            num = float(num)
+            self.push_int(int(num) if num == int(num) else num)
 
-            self.halt()
+        else:
+            self._eof = True
+            self.push_int(-1)
 
-        elif instruction == 'I':
-            num = ""
-            char = self.read_char()
+    def op_jump_cond(self):
+        y = self.pop()
+        x = self.pop()
+        condition = self.pop()
 
-            while char >= 0 and chr(char) not in "-0123456789.":
-                char = self.read_char()
+        if condition:
+            self._x, self._y = int(x), int(y)
 
-            while char >= 0 and chr(char) in "-0123456789.":
-                if chr(char) == '.' and '.' in num:
-                    break
+    def op_kopy_n(self):
+        elem = self.pop()
 
-                if chr(char) == '-' and num:
-                    break
+        if self._memory_limit is not None:
+            self.reserve(elem, 2)
 
-                num += chr(char)
-                char = self.read_char()
+        popped = self._curr_stack.pop_n(elem)
 
-            self._input_buffer = char
+        self._curr_stack.extend(popped)
+        self._curr_stack.extend(popped)
 
-            if num:
-                num = float(num)
-                self.push(int(num) if num == int(num) else num)
+    def op_loop_counter(self):
+        if self._bookmark_stack and self._bookmark_stack[-1].kind >= FOR_LOOP:
+            self.push_int(self._bookmark_stack[-1].counter)
+        else:
+            self.push_int(self._last_loop_counter)
 
-            else:
-                self._eof = True
-                self.push(-1)
+    def op_decrement(self):
+        elem = self.pop()
+        self.push(elem - 1)
 
-        elif instruction == 'J':
-            y = self.pop()
-            x = self.pop()
-            condition = self.pop()
+    def op_num_out_nl(self):
+        self.output_as_num(self.pop())
+        self.output('\n')
 
-            if condition:
-                self._pos = [x, y]
+    def op_increment(self):
+        elem = self.pop()
+        self.push(elem + 1)
 
-        elif instruction == 'K':
-            elem = self.pop()
-            popped = [self.pop() for _ in range(elem)][::-1]
+    def op_qmark_any(self):
+        cond = self.pop()
 
-            self._curr_stack.extend(popped)
-            self._curr_stack.extend(popped)
+        if cond:
+            bookmark = IfBookmark(self.pos_before(), self._dir)
+            self._bookmark_stack.append(bookmark)
+        else:
+            self.to_block_end()
 
-        elif instruction == 'L':
-            if self._bookmark_stack and isinstance(self._bookmark_stack[-1], LoopBookmark):
-                self.push(self._bookmark_stack[-1].counter)
-            else:
-                self.push(self._last_loop_counter)
+    def op_repeat(self):
+        elem = self.pop()
+        self._R_repeat = elem
 
-        elif instruction == 'M':
-            elem = self.pop()
-            self.push(elem - 1)
+    def op_switch(self):
+        raise InvalidStateException # Shouldn't reach here
 
-        elif instruction == 'N':
-            self.output_as_num(self.pop())
-            self.output('\n')
+    def op_teleport_pad(self):
+        self._teleport_pos = (self._x, self._y)
+        self._teleport_dir = self._dir
 
-        elif instruction == 'P':
-            elem = self.pop()
-            self.push(elem + 1)
+    def op_var(self):
+        self.move()
+        char = self.char(num=False)
 
-        elif instruction == 'Q':
-            cond = self.pop()
+        elem = self.pop()
+        self.push_int(elem)
+        self._variable_map[char] = elem
+        self.redefined(char)
 
-            if cond:
-                bookmark = IfBookmark(self.pos_before(), self._dir[:])
-                self._bookmark_stack.append(bookmark)
-            else:
-                self.to_block_end()
+    def op_while(self):
+        if self._bookmark_stack and self._bookmark_stack[-1].pos == self.pos_before():
+            self._bookmark_stack[-1].increment_counter()
+            self._last_loop_counter = self._bookmark_stack[-1].counter
 
-        elif instruction == 'R':
-            elem = self.pop()
-            self._R_repeat = elem
+        else:
+            if self._marker_stack:
+                w_marker = self._marker_stack.pop()
+            else:
+                w_marker = None
 
-        elif instruction == 'S':
-            raise InvalidStateException # Shouldn't reach here
+            bookmark = WhileBookmark(self.pos_before(), self._dir,
+                                     self._closure_stack, w_marker)
 
-        elif instruction == 'T':
-            self._teleport_pos = self._pos[:]
-            self._teleport_dir = self._dir[:]
+            self._bookmark_stack.append(bookmark)
+            self._closure_stack = []
 
-        elif instruction == 'V':
-            self.move()
-            char = self.char(num=False)
+        elem = self.pop()
+        if not self._bookmark_stack[-1].w_marker:
+            self.push_int(elem)
 
-            elem = self.pop()
-            self.push(elem)
-            self._variable_map[char] = elem
+        if not elem:
+            self.bookmark_break()
+        else:
+            self._curr_stack.extend(self._bookmark_stack[-1].closure_stack)
 
-        elif instruction == 'W':
-            if self._bookmark_stack and self._bookmark_stack[-1].pos == self.pos_before():
-                self._bookmark_stack[-1].increment_counter()
-                self._last_loop_counter = self._bookmark_stack[-1].counter
-                
-            else:
-                if self._marker_stack:
-                    w_marker = self._marker_stack.pop()
-                else:
-                    w_marker = None
-                    
-                bookmark = WhileBookmark(self.pos_before(), self._dir[:],
-                                         self._closure_stack, w_marker)
-                
-                self._bookmark_stack.append(bookmark)
-                self._closure_stack = []
+    def op_exponentiate(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
+        result = elem1 ** elem2
 
-            elem = self.pop()
-            if not self._bookmark_stack[-1].w_marker:
-                self.push(elem)
-            
-            if not elem:
-                self.bookmark_break()
-            else:
-                self._curr_stack.extend(self._bookmark_stack[-1].closure_stack)
+        if isinstance(result, complex):
+            raise InvalidStateException("Computation resulted in a complex number")
 
-        elif instruction == 'X':
-            elem2 = self.pop()
-            elem1 = self.pop()
-            result = elem1 ** elem2
+        self.push(result)
 
-            if isinstance(result, complex):
-                raise InvalidStateException("Computation resulted in a complex number")
-            
-            self.push(result)
+    def op_zero_cond(self):
+        condition = self.pop()
 
-        elif instruction == 'Z':
-            condition = self.pop()
+        if condition:
+            self._skip = 1
 
-            if condition:
-                self._skip = 1
+    def op_merge_left(self):
+        buffer, self._stack_tape[self._stack_num] = self._curr_stack, Stack()
+        self.stack_left()
+        self._curr_stack.extend(buffer)
 
-        elif instruction == '[':
-            buffer, self._stack_tape[self._stack_num] = self._curr_stack, []
-            self.stack_left()
-            self._curr_stack.extend(buffer)
+    def op_split_right(self):
+        n = self.pop()
 
-        elif instruction == ']':
-            n = self.pop()
-            buffer = []
+        if self._memory_limit is not None:
+            self.reserve(n, 1)
 
-            for _ in range(n):
-                buffer.append(self.pop())
+        buffer = self._curr_stack.pop_n(n)
 
-            self.stack_right()
+        self.stack_right()
+        self._curr_stack.extend(buffer)
 
-            while buffer:
-                self.push(buffer.pop())
+    def op_escape(self):
+        self.move()
+        char = self.char()
+        self.push_int(char)
 
-        elif instruction == '`':
-            self.move()
-            char = self.char()
-            self.push(char)
+    def op_get(self):
+        y = self.pop()
+        x = self.pop()
 
-        elif instruction == 'g':
-            y = self.pop()
-            x = self.pop()
+        self.push_int(self._board.get(x, y))
 
-            if y in self._board and x in self._board[y]:
-                self.push(self._board[y][x])
-            else:
-                self.push(0)
+    def op_halt_num(self):
+        self.output_as_num(self.pop())
+        self.halt()
 
-        elif instruction == 'h':
-            self.output_as_num(self.pop())
-            self.halt()
+    def op_input_char(self):
+        char = self.read_char()
 
-        elif instruction == 'i':
-            char = self.read_char()
+        if char == EOF:
+            self._eof = True
 
-            if char == EOF:
-                self._eof = True
+        self.push_int(char)
 
-            self.push(char)
+    def op_closure(self):
+        elem = self.pop()
+        self._closure_stack.append(elem)
 
-        elif instruction == 'j':
-            elem = self.pop()
-            self._closure_stack.append(elem)
+    def op_kopy_nth(self):
+        elem = self.pop()
 
-        elif instruction == 'k':
-            elem = self.pop()
+        if self._curr_stack:
+            self.push_int(self._curr_stack[~elem % len(self._curr_stack)])
+        else:
+            self.push_int(0)
 
-            if self._curr_stack:
-                self.push(self._curr_stack[~elem % len(self._curr_stack)])
-            else:
-                self.push(0)
+    def op_length(self):
+        self.push_int(len(self._curr_stack))
 
-        elif instruction == 'l':
-            self.push(len(self._curr_stack))
+    def op_push_minus1(self):
+        self.push_int(-1)
 
-        elif instruction == 'm':
-            self.push(-1)
+    def op_num_out(self):
+        self.output_as_num(self.pop())
 
-        elif instruction == 'n':
-            self.output_as_num(self.pop())
+    def op_char_out(self):
+        self.output_as_char(self.pop())
 
-        elif instruction == 'o':
-            self.output_as_char(self.pop())
+    def op_put(self):
+        elem3 = self.pop()
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == 'p':
-            elem3 = self.pop()
-            elem2 = self.pop()
-            elem1 = self.pop()
+        y = elem3
+        x = elem2
+        char = elem1
+        self._board.set(x, y, char)
 
-            y = elem3
-            x = elem2
-            char = elem1
-            self._board[y][x] = char                  
-                    
-        elif instruction == 'q':
-            cond = self.pop()
+    def op_qmark2(self):
+        cond = self.pop()
 
-            if not cond:
-                self._skip = 2
+        if not cond:
+            self._skip = 2
 
-        elif instruction == 'r':
-            self._curr_stack.reverse()
+    def op_reverse(self):
+        self._curr_stack.reverse()
 
-        elif instruction == 's':
-            elem = self.pop()
-            self.push(elem + 16)
+    def op_sixteen(self):
+        elem = self.pop()
+        self.push(elem + 16)
 
-        elif instruction == 't':
-            self._pos = self._teleport_pos[:]
-            self._dir = self._teleport_dir[:]
+    def op_teleport(self):
+        self._x, self._y = self._teleport_pos
+        self._dir = self._teleport_dir
 
-        elif instruction == 'u':
-            self.stack_right()
-            
-        elif instruction == 'w':
-            self._marker_stack.append([self._pos[:], self._dir[:]])
-                
-        elif instruction == 'x':
-            self._dir = random.choice(list(DIRECTIONS.values()))
+    def op_stack_right(self):
+        self.stack_right()
 
-        elif instruction == 'y':
-            self.stack_left()
+    def op_while_marker(self):
+        self._marker_stack.append(((self._x, self._y), self._dir))
 
-        elif instruction == 'z':
-            elem = self.pop()
-            self.push(0 if elem else 1)
+    def op_random_dir(self):
+        self._dir = self.rng().choice(RANDOM_DIRS)
 
-        elif instruction == '{':
-            self.rotate_left()
+    def op_stack_left(self):
+        self.stack_left()
 
-        elif instruction == '|':
-            if self._bookmark_stack and isinstance(self._bookmark_stack[-1], IfBookmark):
-                self._bookmark_stack.pop()
-                
-            elif self._bookmark_stack and isinstance(self._bookmark_stack[-1], LoopBookmark):
-                bookmark = self._bookmark_stack[-1]
-                self._pos = bookmark.pos[:]
-                self._dir = bookmark.dir[:]
+    def op_is_zero(self):
+        elem = self.pop()
+        self.push_int(0 if elem else 1)
 
-                if isinstance(bookmark, WhileBookmark) and bookmark.w_marker:
-                        self._pos = bookmark.w_marker[0][:]
-                        self._dir = bookmark.w_marker[1][:]
+    def op_rotate_left(self):
+        self.rotate_left()
 
-            else:
-                raise InvalidStateException("Unexpected if/loop end")
+    def op_block_end(self):
+        if self._bookmark_stack and self._bookmark_stack[-1].kind == IF_BLOCK:
+            self._bookmark_stack.pop()
 
-        elif instruction == '}':
-            self.rotate_right()
+        elif self._bookmark_stack and self._bookmark_stack[-1].kind >= FOR_LOOP:
+            bookmark = self._bookmark_stack[-1]
+            self._x, self._y = bookmark.pos
+            self._dir = bookmark.dir
 
-        elif instruction == '~':
-            self.pop()
+            if bookmark.kind == WHILE_LOOP and bookmark.w_marker:
+                    (self._x, self._y), self._dir = bookmark.w_marker
 
         else:
-            raise NotImplementedError
+            raise InvalidStateException("Unexpected if/loop end")
 
+    def op_rotate_right(self):
+        self.rotate_right()
 
-    def handle_switched_instruction(self, instruction):
-        if instruction == '"':
-            escaped = False
-            parse_char = ord(instruction)
-            self.move()
-            char = self._board[self._pos[1]][self._pos[0]]
-            
-            while escaped or char != parse_char:
-                if escaped:
-                    escapes = {ord(a): ord(b) for a,b in zip("`nr","`\n\r")}
-                    escapes.update({parse_char: parse_char})
+    def op_discard(self):
+        self.pop()
 
-                    if char in escapes:
-                        self.output_as_char(escapes[char])
-                    else:
-                        self.output('`')
-                        self.output_as_char(char)
 
-                    escaped = False
+    # Switched instructions
 
-                else:
-                    if char == ord('`'):
-                        escaped = True
-                    else:
-                        self.output_as_char(char)
+    def op_print_string(self):
+        chars, end = self.string_literal(ord('"'))
 
-                self.move()
-                char = self._board[self._pos[1]][self._pos[0]]
-        
-        elif instruction == '%':
-            elem2 = self.pop()
-            elem1 = self.pop()
+        self._x, self._y = end
+        self.output("".join(map(self.chr, chars)))
 
-            self.push(gcd(elem1, elem2))
+    def op_gcd(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == '&':
-            elem2 = self.pop()
-            elem1 = self.pop()
+        self.push_int(gcd(elem1, elem2))
 
-            self.push(elem1 & elem2)
+    def op_bitwise_and(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == '(':
-            elem = self.pop()
-            self.push(math.floor(elem))
+        self.push_int(elem1 & elem2)
 
-        elif instruction == ')':
-            elem = self.pop()
-            self.push(math.ceil(elem))
+    def op_floor(self):
+        elem = self.pop()
+        self.push_int(math.floor(elem))
 
-        elif instruction == ',':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_ceil(self):
+        elem = self.pop()
+        self.push_int(math.ceil(elem))
 
-            self.push(int(elem1 // elem2))
+    def op_int_divide(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == '2':
-            self.push(math.e)
+        self.push_int(int(elem1 // elem2))
 
-        elif instruction == '3':
-            self.push(math.pi)
+    def op_push_e(self):
+        self.push(math.e)
 
-        elif instruction == '<':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_push_pi(self):
+        self.push(math.pi)
 
-            self.push(min(elem1, elem2))
+    def op_min(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == '=':
-            elem = self.pop()
-            self.push(round(elem))
+        self.push(min(elem1, elem2))
 
-        elif instruction == '>':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_round(self):
+        elem = self.pop()
+        self.push_int(round(elem))
 
-            self.push(max(elem1, elem2))
+    def op_max(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == 'A':
-            elem = self.pop()
-            self.push(abs(elem))
+        self.push(max(elem1, elem2))
 
-        elif instruction == 'D':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_abs(self):
+        elem = self.pop()
+        self.push(abs(elem))
 
-            self.push(elem1 // elem2)
-            self.push(elem1 % elem2)
+    def op_divmod(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == 'E':
-            self.push(int(self._eof))
+        self.push(elem1 // elem2)
+        self.push(elem1 % elem2)
 
-        elif instruction == 'L':
-            elem2 = self.pop()
-            elem1 = self.pop()
-            self.push(math.log(elem1, elem2))
+    def op_eof_flag(self):
+        self.push_int(int(self._eof))
 
-        elif instruction == 'P':
-            elem = self.pop()
-            self.push(1 if is_probably_prime(elem) else 0)
+    def op_log(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
+        self.push(math.log(elem1, elem2))
 
-        elif instruction == 'T':
-            func_num = self.pop()
-            functions = [math.sin, math.cos, math.tan, math.sinh, math.cosh, math.tanh,
-                         math.asin, math.acos, math.atan, math.asinh, math.acosh, math.atanh, math.atan2]
+    def op_prime(self):
+        elem = self.pop()
+        self.push_int(1 if is_probably_prime(elem, self.rng) else 0)
 
-            elem = self.pop()
-            self.push(functions[func_num % len(functions)](elem))
+    def op_trig(self):
+        func_num = self.pop()
+        functions = [math.sin, math.cos, math.tan, math.sinh, math.cosh, math.tanh,
+                     math.asin, math.acos, math.atan, math.asinh, math.acosh, math.atanh, math.atan2]
 
-        elif instruction == ']':
-            n = self.pop()
-            buffer = []
+        elem = self.pop()
+        self.push(functions[func_num % len(functions)](elem))
 
-            for _ in range(n):
-                buffer.append(self.pop())
+    def op_copy_split_right(self):
+        n = self.pop()
 
-            self.stack_right()
+        if self._memory_limit is not None:
+            self.reserve(n, 2)
 
-            while buffer:
-                elem = buffer.pop()
-                self.push(elem)
-                self._stack_tape[self._stack_num-1].append(elem)
+        buffer = self._curr_stack.pop_n(n)
 
-        elif instruction == '^':
-            elem2 = self.pop()
-            elem1 = self.pop()
+        self.stack_right()
+        self._curr_stack.extend(buffer)
+        self._stack_tape[self._stack_num-1].extend(buffer)
 
-            self.push(elem1 ^ elem2)
+    def op_bitwise_xor(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        elif instruction == 'l':
-            elem = self.chr(self.pop())
-            self.push(ord(elem.lower()))
+        self.push_int(elem1 ^ elem2)
 
-        elif instruction == 'n':
-            places = self.pop()
-            num = self.pop()
-            self.output("{{:.{}f}}".format(places).format(float(num)))
+    def op_lower(self):
+        elem = self.chr(self.pop())
+        self.push_int(ord(elem.lower()))
 
-        elif instruction == 'u':
-            elem = self.chr(self.pop())
-            self.push(ord(elem.upper()))
+    def op_num_rounding(self):
+        places = self.pop()
+        num = self.pop()
+        self.output("{{:.{}f}}".format(places).format(float(num)))
 
-        elif instruction == 'x':
-            self.push(random.random())
+    def op_upper(self):
+        elem = self.chr(self.pop())
+        self.push_int(ord(elem.upper()))
 
-        elif instruction == '|':
-            elem2 = self.pop()
-            elem1 = self.pop()
+    def op_random_float(self):
+        self.push(self.rng().random())
 
-            self.push(elem1 | elem2)
+    def op_bitwise_or(self):
+        elem2 = self.pop()
+        elem1 = self.pop()
 
-        else:
-            raise NotImplementedError
+        self.push_int(elem1 | elem2)
 
 
     def push(self, elem, index=None):
-        if elem == int(elem):
+        # Normalise integral floats to ints, e.g. 4/2 pushes 2 and not 2.0
+        if type(elem) is not int and elem == int(elem):
             elem = int(elem)
 
         if index is None:
@@ -912,22 +2093,64 @@ class Golfish():
             self._curr_stack.insert(index, elem)
 
 
+    def push_int(self, elem):
+        # Fast path for values which are already ints, or which came off a
+        # stack and so were already normalised by push
+        self._curr_stack.append(elem)
+
+
     def pop(self, index=None):
         if self._curr_stack:
             if index is None:
                 return self._curr_stack.pop()
             else:
-                return self._curr_stack.pop(index)
+                elem = self._curr_stack[index]
+                del self._curr_stack[index]
+                return elem
 
         else:
             return 0
 
 
+    def memo_pop(self, index=None):
+        # pop, also noting how far down the stack pure calls being recorded
+        # reach. Used in place of pop when memoising aliases.
+        frames = self._memo_frames
+
+        if frames:
+            frame = frames[-1]
+            depth = len(self._curr_stack)
+
+            if not depth:
+                frame.bottomed = True
+
+            elif index is None and depth - 1 < frame.low:
+                elem = self._curr_stack.pop()
+                frame.low = depth - 1
+                frame.consumed.append(elem)
+                return elem
+
+            elif index is not None:
+                frame.bottomed = True # Not tracked, so never cached
+
+        return Golfish.pop(self, index)
+
+
+    def rng(self):
+        # Created on first use, so that random is only imported by programs
+        # which need it
+        if self._random is None:
+            import random
+            self._random = random.Random(self._seed)
+
+        return self._random
+
+
     def char(self, num=True):
         if num:
-            return self._board[self._pos[1]][self._pos[0]]
+            return self._board.get(self._x, self._y)
         else:
-            return self.chr(self._board[self._pos[1]][self._pos[0]])
+            return self.chr(self._board.get(self._x, self._y))
 
 
     def chr(self, elem):
@@ -935,11 +2158,18 @@ class Golfish():
 
 
     def rotate_left(self):
-        self.push(self.pop(index=0))
+        # Bottom to top, or push 0 if empty (bottomless stack)
+        if self._curr_stack:
+            self._curr_stack.rotate(-1)
+        else:
+            self._curr_stack.append(0)
 
 
     def rotate_right(self):
-        self.push(self.pop(), index=0)
+        if self._curr_stack:
+            self._curr_stack.rotate(1)
+        else:
+            self._curr_stack.append(0)
 
 
     def stack_left(self):
@@ -954,29 +2184,125 @@ class Golfish():
 
     def bookmark_break(self):
         bookmark = self._bookmark_stack.pop()
-        self._pos = bookmark.pos[:]
-        self._dir = bookmark.dir[:]
+        self._x, self._y = bookmark.pos
+        self._dir = bookmark.dir
         
-        if not isinstance(bookmark, FunctionBookmark):
+        if bookmark.kind != FUNCTION_CALL:
             self.to_block_end()
 
+        elif self._memo_frames and self._memo_frames[-1].bookmark is bookmark:
+            self.end_memo_frame()
+
+
+    def loop_body(self):
+        # The ops of the F loop just entered, if its body is a straight run
+        # of traceable instructions up to its |, else None. Traces can't
+        # hold block openers, quotes or skips, so the first | a trace stops
+        # at is the matching one, without scanning for it - which might
+        # never end for an F entered from off the board.
+        dir_index = self._dir
+        x, y = self._board.advance(self._x, self._y, DIRS[dir_index])
+        ops, end = self.trace(x, y, dir_index)
+
+        if (end is None or self._board.cell(*end) != ord('|')
+            or '|' in self._variable_map or '|' in self._function_alias_map):
+
+            return None
+
+        return ops
+
+
+    def run_for_loop(self, bookmark, ops):
+        # Equivalent to running the loop tick by tick from the F just run:
+        # each iteration is the body, then | and F again, until F breaks
+        # out. If the stop tick falls within an iteration, that iteration is
+        # left to run tick by tick, so that it stops on exactly the same
+        # tick, and op_for() brings the loop back here when it comes round.
+        tick_limit = self._stop_tick
+        limit = bookmark.limit
+        closure_stack = bookmark.closure_stack
+        iteration_ticks = len(ops) + 2
+        x, y = self._x, self._y
+        counter = bookmark.counter
+        bookmark.fast = True
+
+        while counter < limit:
+            self._curr_stack.extend(closure_stack)
+
+            # The ticks so far, less the entering F's, which tick() counts
+            if tick_limit is not None and self._ticks + iteration_ticks >= tick_limit:
+                self._x, self._y = x, y
+                break
+
+            self.replay(ops)
+            self._ticks += 2
+
+            counter += 1
+            bookmark.counter = counter
+
+        else:
+            if counter:
+                self._last_loop_counter = counter
+
+            self.bookmark_break()
+            return
+
+        if counter:
+            self._last_loop_counter = counter
+
+
     def to_block_end(self):
-        # TODO: improve
-        start_pos = self._pos[:]
-        self.move()
+        # Jump from a block opener (or a bookmark position just before it)
+        # to its matching |
+        self._x, self._y = self.block_end(self._x, self._y, self._dir)
+
+
+    def redefined(self, char):
+        # After A or V makes char a function or variable: traces and memoised
+        # calls may run it as an instruction, and a quote stops starting
+        # strings in find_block_end(), so cached block ends may be wrong too
+        self._traces.clear()
+
+        if self._alias_memo is not None:
+            self._alias_memo.clear()
+
+        if char in "'\"":
+            self._block_ends.clear()
+
+
+    def block_end(self, x, y, dir_index):
+        key = (x, y, dir_index)
+        end = self._block_ends.get(key)
+
+        if end is None:
+            end = self.find_block_end(*key)
+
+        return end
+
+
+    def find_block_end(self, x, y, dir_index):
+        start = (x, y)
+        dir_ = DIRS[dir_index]
+        cells = []
+
+        def next_char():
+            nonlocal x, y
+            x, y = self._board.advance(x, y, dir_)
+            cells.append((x, y))
+            return self.chr(self._board.get(x, y))
+
+        c = next_char()
+
+        if c in "FWQ":
+            c = next_char()
 
-        if self.char(num=False) in "FWQ":
-            self.move()
-        
         string_parse = False
         escape = False
         switched = False
         depth = 0
 
-        while depth or string_parse or escape or switched or self.char(num=False) != '|':
+        while depth or string_parse or escape or switched or c != '|':
             # Need to check VA for everything here
-            c = self.char(num=False)
-            
             if switched:
                 switched = False
 
@@ -1001,11 +2327,61 @@ class Golfish():
                 elif c == 'S':
                     switched = True
 
-            self.move()
+            c = next_char()
 
-            if self._pos == start_pos:
+            if (x, y) == start:
                 raise InvalidStateException("Missing | end")
-        
+
+        self._block_ends.add((start[0], start[1], dir_index), (x, y), cells)
+        return (x, y)
+
+    def string_literal(self, parse_char):
+        # The string starting at the current position, as (chars, end)
+        key = (self._x, self._y, self._dir, parse_char)
+        literal = self._strings.get(key)
+
+        if literal is None:
+            literal = self.lex_string(*key)
+
+        return literal
+
+
+    def lex_string(self, x, y, dir_index, parse_char):
+        # Decode the string from the quote at (x, y) up to the closing
+        # quote, which is where the IP ends up
+        start = (x, y)
+        dir_ = DIRS[dir_index]
+        cells = [start]
+        chars = []
+        escaped = False
+
+        while True:
+            x, y = self._board.advance(x, y, dir_)
+            cells.append((x, y))
+            char = self._board.get(x, y)
+
+            if escaped:
+                if char in ESCAPES or char == parse_char:
+                    chars.append(ESCAPES.get(char, char))
+                else:
+                    chars.append(ord('`'))
+                    chars.append(char)
+
+                escaped = False
+
+            elif char == parse_char:
+                break
+
+            elif char == ord('`'):
+                escaped = True
+
+            else:
+                chars.append(char)
+
+        literal = (tuple(chars), (x, y))
+        self._strings.add((start[0], start[1], dir_index, parse_char), literal, cells)
+        return literal
+
     def read_char(self):
         # Note: self._eof not set here, but in input instructions
         if self._input_buffer is not None:
@@ -1013,37 +2389,85 @@ class Golfish():
             self._input_buffer = None
             return char
             
-        if self._input is None:
-            if sys.stdin.isatty():
-                # Console
-                char = getch()
+        if self._input_pos < len(self._input):
+            char = self._input[self._input_pos]
+            self._input_pos += 1
+            return ord(char)
 
-                if ord(char) == 3:
-                    raise KeyboardInterrupt
+        if self._input_eof:
+            return EOF
 
-            else:
-                char = sys.stdin.read(1)
+        return self.read_stdin()
 
-            if char:
-                return ord(char)
-            else:
+    def read_stdin(self):
+        self._output_buffer.flush()
+
+        if self._async_input:
+            raise NeedInput
+
+        stdin = self.stream("stdin")
+        isatty = getattr(stdin, "isatty", None)
+
+        if isatty is not None and isatty():
+            # Console
+            char = getch()
+
+            if ord(char) == 3:
+                raise KeyboardInterrupt
+
+        elif self._stream_input or is_binary(stdin):
+            chunk = self.read_stdin_chunk(stdin)
+
+            if not chunk:
+                self._input_eof = True
                 return EOF
 
+            self._input = chunk
+            self._input_pos = 1
+            return ord(chunk[0])
+
         else:
-            if self._input:
-                c = self._input[0]
-                self._input = self._input[1:]
-                return ord(c)
+            char = stdin.read(1)
 
-            else:
-                return EOF
+        if char:
+            return ord(char)
+        else:
+            return EOF
+
+    def read_stdin_chunk(self, stdin):
+        # Whatever stdin has available, up to INPUT_CHUNK_SIZE chars, without
+        # waiting for a whole chunk to arrive. Returns "" on EOF. Binary
+        # streams are decoded as UTF-8.
+        if is_binary(stdin):
+            raw, encoding, errors = stdin, "utf-8", "strict"
+        else:
+            raw = getattr(stdin, "buffer", None)
+
+            if raw is None or not hasattr(raw, "read1"):
+                return stdin.read(INPUT_CHUNK_SIZE)
+
+            encoding, errors = stdin.encoding, stdin.errors
+
+        if self._stdin_decoder is None:
+            # Decode like sys.stdin would, universal newlines included
+            import codecs
+            decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors or "strict")
+            self._stdin_decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+
+        read = getattr(raw, "read1", raw.read)
+
+        while True:
+            data = read(INPUT_CHUNK_SIZE)
+            chunk = self._stdin_decoder.decode(data, final=not data)
+
+            if chunk or not data:
+                return chunk
 
     def output(self, out):
         if out:
             self._last_output = out[-1]
 
-        sys.stdout.write(out)
-        sys.stdout.flush()
+        self._output_buffer.write(out)
             
 
     def output_as_char(self, out):
@@ -1072,36 +2496,136 @@ class Golfish():
 
 
     def print_error(self, *objects, end=""):
+        self._output_buffer.flush()
+        text = " ".join(map(str, objects)) + end
+
         if self._online:
-            print(*objects, end=end)
+            self._output_buffer.write(text)
+            self._output_buffer.flush()
         else:
-            print(*objects, end=end, file=sys.stderr)
+            stderr = self.stream("stderr")
+            write_text(stderr, text)
+            flush_stream(stderr)
 
 
     def traceback(self, e):
         if self._debug:
+            self._output_buffer.flush()
+
             if self._online:
-                traceback.print_exc(file=sys.stdout)
+                import traceback
+                self._output_buffer.write(traceback.format_exc())
+                self._output_buffer.flush()
             else:
                 raise e
 
 
+    def stream(self, name):
+        # The stream for "stdout", "stderr" or "stdin"
+        stream = getattr(self, "_" + name)
+        return getattr(sys, name) if stream is None else stream
+
+
+    def status(self):
+        # How the program ended, as run() returned it, or None if it hasn't
+        return self._status
+
+
+    def ticks(self):
+        return self._ticks
+
+
+    def flush(self):
+        # Write out any output still buffered
+        self._output_buffer.flush()
+
+
+    def abort(self, e):
+        # Stop the program for an exception raised from outside, such as a
+        # signal handler, reporting it as run() would had it come from the
+        # program. Returns the status, which is unchanged if the program
+        # had already stopped.
+        if self._status is None:
+            self.stopped(e)
+
+        self.flush()
+        return self._status
+
+
 if __name__ == "__main__":
+    import argparse
+    import codecs
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', help="Debug mode (show interpreter errors)", action="store_true")
+    parser.add_argument('-c', '--compile', help="Compile to Python first, if the program allows it",
+                        action="store_true")
+    parser.add_argument('--flush', help="When to flush output (default: line on a terminal, else block)",
+                        choices=[FLUSH_CHAR, FLUSH_LINE, FLUSH_BLOCK])
+    parser.add_argument('--memoize-aliases', help="Cache results of A functions without side effects",
+                        action="store_true")
+    parser.add_argument('--seed', help="Seed for x, Sx and SP, to make runs reproducible", type=int)
+    parser.add_argument('--tick-limit', help="Stop with [Timeout] after this many ticks", type=int)
+    parser.add_argument('--time-limit', help="Stop with [Time limit] after this many seconds",
+                        type=float)
+    parser.add_argument('--memory-limit', help="Stop with [Memory limit] beyond this many stack elements",
+                        type=int)
+    parser.add_argument('--serve', help="Run programs sent as JSON lines on stdin, see server.py",
+                        action="store_true")
+    parser.add_argument('--socket', help="With --serve, listen on a Unix socket at this path instead")
+    parser.add_argument('--batch', help="Run the jobs in a JSON lines file across processes, see batch.py",
+                        metavar="JOBS")
+    parser.add_argument('--workers', help="With --batch, number of worker processes (default: one per core)",
+                        type=int)
     parser.add_argument("program_path", help="Path to file containing program",
-                        type=str)
+                        type=str, nargs="?")
 
     args = parser.parse_args()
+
+    if args.serve:
+        try:
+            from server import serve_socket, serve_stdio
+        except ImportError:
+            from .server import serve_socket, serve_stdio
+
+        if args.socket:
+            serve_socket(args.socket)
+        else:
+            serve_stdio()
+
+        sys.exit()
+
+    if args.batch:
+        try:
+            from batch import run_batch_file
+        except ImportError:
+            from .batch import run_batch_file
+
+        run_batch_file(args.batch, args.workers)
+        sys.exit()
+
+    if args.program_path is None:
+        parser.error("the program_path argument is required")
+
     filename = args.program_path
     debug = args.debug    
+    compiled = args.compile
+    flush_policy = args.flush
+    memoize_aliases = args.memoize_aliases
+    seed = args.seed
+    limits = {"tick_limit": args.tick_limit, "time_limit": args.time_limit,
+              "memory_limit": args.memory_limit}
 
     try:
         with open(filename) as infile:
-            interpreter = Golfish(infile.read(), debug=debug)
+            interpreter = Golfish(infile.read(), debug=debug, compiled=compiled,
+                                  flush_policy=flush_policy, memoize_aliases=memoize_aliases,
+                                  seed=seed, **limits)
 
     except UnicodeDecodeError:
         with codecs.open(filename, "r", "utf_8") as infile:
-            interpreter = Golfish(infile.read(), debug=debug)
+            interpreter = Golfish(infile.read(), debug=debug, compiled=compiled,
+                                  flush_policy=flush_policy, memoize_aliases=memoize_aliases,
+                                  seed=seed, **limits)
 
     interpreter.run()
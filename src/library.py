@@ -1,58 +1,114 @@
 import math
-import random
+from functools import lru_cache, reduce
+from operator import mul
 
-def is_probably_prime(n):
+SIEVE_LIMIT = 1 << 16
+PRIME_CACHE_SIZE = 4096
+
+# Miller-Rabin with these witnesses is exact for all n < 3.3 * 10**24
+DETERMINISTIC_LIMIT = 3317044064679887385961981
+WITNESSES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+
+def build_sieve(limit):
+    # sieve[n] is 1 if n is prime, for 0 <= n < limit
+    sieve = bytearray([1]) * limit
+    sieve[:2] = b"\0\0"
+
+    for p in range(2, int(math.sqrt(limit - 1)) + 1):
+        if sieve[p]:
+            sieve[p*p::p] = bytes(len(range(p*p, limit, p)))
+
+    return sieve
+
+SIEVE = build_sieve(SIEVE_LIMIT)
+
+# Product of the primes below 200, to weed out most composites with one gcd
+SMALL_PRIMORIAL = reduce(mul, (p for p in range(200) if SIEVE[p]))
+
+
+_isprime = None # sympy's isprime, or False without sympy, once looked up
+
+
+def sympy_isprime():
+    # If you have sympy installed, use that instead. It's slow to import, so
+    # this is only tried once SP meets a number beyond the sieve.
+    global _isprime
+
+    if _isprime is None:
+        try:
+            from sympy.ntheory import isprime
+            _isprime = isprime
+        except ImportError:
+            _isprime = False
+
+    return _isprime
+
+
+def is_probably_prime(n, get_rng=None):
+    # get_rng returns the random.Random to draw witnesses from, for numbers
+    # too large for the deterministic test. Defaults to the random module.
     if not isinstance(n, int):
         return False
 
-    try:
-        # If you have sympy installed, use that instead
-        from sympy.ntheory import isprime
-        return isprime(n)
+    if n < SIEVE_LIMIT:
+        return n >= 0 and SIEVE[n] == 1
 
-    except ImportError:
-        if n < 2:
-            return False
+    if math.gcd(n, SMALL_PRIMORIAL) != 1:
+        return False
 
-        if n in [2, 3]:
-            return True
+    if n < DETERMINISTIC_LIMIT or sympy_isprime():
+        return is_prime_cached(n)
 
-        # Miller Rabin
-        s = 0
-        d = n-1
+    if get_rng is None:
+        import random
+        rng = random
+    else:
+        rng = get_rng()
 
-        while d%2 == 0:
-            d //= 2
-            s += 1
+    return miller_rabin(n, [rng.randint(2, n-2)
+                            for _ in range(10 + int(math.log(n)//math.log(4)))])
 
-        k = 10 + math.log(n)//math.log(4)
-        witness_count = 0
 
-        while witness_count < k:
-            continue_ = False
-            a = random.randint(2, n-2)
-            x = pow(a, d, n)
+@lru_cache(maxsize=PRIME_CACHE_SIZE)
+def is_prime_cached(n):
+    # Exact answers only, so that they are safe to cache
+    isprime = sympy_isprime()
 
-            if x == 1 or x == n-1:
-                witness_count += 1
-                continue
+    if isprime:
+        return isprime(n)
 
-            for _ in range(s-1):
-                x = pow(x, 2, n)
+    return miller_rabin(n, WITNESSES)
 
-                if x == 1:
-                    return False
 
-                if x == n-1:
-                    continue_ = True
-                    break
+def miller_rabin(n, witnesses):
+    # For odd n > 3, with every witness in range(2, n-1)
+    if n % 2 == 0:
+        return False
 
-            if not continue_:
+    s = 0
+    d = n-1
+
+    while d%2 == 0:
+        d //= 2
+        s += 1
+
+    for a in witnesses:
+        x = pow(a, d, n)
+
+        if x == 1 or x == n-1:
+            continue
+
+        for _ in range(s-1):
+            x = pow(x, 2, n)
+
+            if x == 1:
                 return False
 
-            witness_count += 1
+            if x == n-1:
+                break
 
-        return True
+        else:
+            return False
 
-    
-            
+    return True
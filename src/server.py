@@ -0,0 +1,203 @@
+"""
+Long-running Gol><> server, to avoid paying for Python startup on every run
+
+Requests and responses are JSON objects, one per line, read from stdin and
+written to stdout, or exchanged over connections to a Unix socket. Each
+request is {"code": ..., "input": ..., "tick_limit": ..., "time_limit": ...,
+"memory_limit": ...}, where only code is required, and is run by a fresh
+Golfish with those limits. time_limit is in seconds of wall-clock time. The
+interpreter only checks it every so many ticks, so where signal.setitimer is
+available and the server runs in the main thread, a timer signal also stops
+runs stuck in one slow instruction. The response is
+{"stdout": ..., "stderr": ..., "ticks": ..., "status": ...}, where status
+is one of the statuses returned by Golfish.run(), or "invalid" for a
+request which couldn't be run. Any "id" in the request is echoed back.
+
+Programs without input get empty input rather than reading stdin, and
+boards are parsed once per distinct program and copied for each run.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+import json
+import signal
+import sys
+import threading
+
+try:
+    from golfish import FLUSH_BLOCK, INTERRUPTED, Golfish, Playfield, TimeLimitExceeded
+except ImportError:
+    from .golfish import FLUSH_BLOCK, INTERRUPTED, Golfish, Playfield, TimeLimitExceeded
+
+INVALID = "invalid"
+BOARD_CACHE_SIZE = 256
+
+
+@contextmanager
+def wall_clock_limit(seconds):
+    # Raise TimeLimitExceeded, which Golfish.run() reports as running out of
+    # time, if the block takes longer than seconds. The timer can also go off
+    # just after the block, raising from the with statement itself. Does
+    # nothing if the platform or thread can't have a timer signal.
+    if (seconds is None or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()):
+
+        yield
+        return
+
+    def alarm(signum, frame):
+        raise TimeLimitExceeded
+
+    handler = signal.signal(signal.SIGALRM, alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    try:
+        yield
+    finally:
+        # The timer is one-shot, so once it is disarmed or has gone off,
+        # restoring the handler can't be cut short
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        finally:
+            signal.signal(signal.SIGALRM, handler)
+
+
+class Server():
+    def __init__(self, tick_limit=None, cache_size=BOARD_CACHE_SIZE):
+        self._tick_limit = tick_limit # default for requests without one
+        self._cache_size = cache_size
+        self._boards = OrderedDict() # code -> Playfield, least recent first
+
+        self.interrupted = False
+
+    def board(self, code):
+        # code's parsed board, which Golfish copies rather than changing it
+        board = self._boards.get(code)
+
+        if board is None:
+            board = self._boards[code] = Playfield(code)
+
+            if len(self._boards) > self._cache_size:
+                self._boards.popitem(last=False)
+        else:
+            self._boards.move_to_end(code)
+
+        return board
+
+    def handle(self, line):
+        # Response to one request line, as a JSON line
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = invalid(e)
+        else:
+            response = self.respond(request)
+
+        return json.dumps(response) + "\n"
+
+    def respond(self, request):
+        # Response to a decoded request
+        try:
+            response = self.run(request)
+        except (ValueError, TypeError, KeyError) as e:
+            response = invalid(e)
+
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+
+        return response
+
+    def run(self, request):
+        code = request["code"]
+        input_ = request.get("input") or ""
+        tick_limit = request.get("tick_limit", self._tick_limit)
+        time_limit = request.get("time_limit")
+        memory_limit = request.get("memory_limit")
+
+        if not isinstance(code, str) or not isinstance(input_, str):
+            raise TypeError("code and input must be strings")
+
+        if tick_limit is not None and not isinstance(tick_limit, int):
+            raise TypeError("tick_limit must be an integer")
+
+        if time_limit is not None and not isinstance(time_limit, (int, float)):
+            raise TypeError("time_limit must be a number")
+
+        if memory_limit is not None and not isinstance(memory_limit, int):
+            raise TypeError("memory_limit must be an integer")
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        interpreter = Golfish(self.board(code), input_, tick_limit=tick_limit,
+                              flush_policy=FLUSH_BLOCK, stdout=stdout, stderr=stderr,
+                              time_limit=time_limit, memory_limit=memory_limit)
+
+        try:
+            with wall_clock_limit(time_limit):
+                status = interpreter.run()
+
+        except TimeLimitExceeded as e:
+            # The timer went off outside run()'s own handling, either after
+            # the program stopped or while run() was tidying up
+            status = interpreter.abort(e)
+
+        if status == INTERRUPTED:
+            self.interrupted = True
+
+        return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(),
+                "ticks": interpreter.ticks(), "status": status}
+
+    def serve(self, infile, outfile):
+        # Answer each request line from infile on outfile, until EOF
+        for line in infile:
+            if not line.strip():
+                continue
+
+            outfile.write(self.handle(line))
+            outfile.flush()
+
+            if self.interrupted:
+                break
+
+
+def invalid(e):
+    return {"stdout": "", "stderr": "{}: {}".format(type(e).__name__, e),
+            "ticks": 0, "status": INVALID}
+
+
+def serve_stdio(tick_limit=None):
+    Server(tick_limit).serve(sys.stdin, sys.stdout)
+
+
+def serve_socket(path, tick_limit=None):
+    # Serve connections to a Unix socket at path, one at a time
+    import os
+    import socketserver
+
+    server = Server(tick_limit)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            infile = io.TextIOWrapper(self.rfile, encoding="utf-8")
+            outfile = io.TextIOWrapper(self.wfile, encoding="utf-8")
+
+            try:
+                server.serve(infile, outfile)
+            finally:
+                # Leave closing the socket to socketserver
+                infile.detach()
+                outfile.detach()
+
+    socket_server = socketserver.UnixStreamServer(path, Handler)
+
+    try:
+        while not server.interrupted:
+            socket_server.handle_request()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        socket_server.server_close()
+        os.remove(path)
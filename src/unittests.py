@@ -1,9 +1,12 @@
 import unittest
 
+from unittests_batch import *
+from unittests_compiler import *
 from unittests_core import *
 from unittests_examples import *
 from unittests_instructions import *
 from unittests_Rinstructions import *
+from unittests_server import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from batch import run_batch
+from golfish import ERRORED, HALTED, OUT_OF_TIME, TIMED_OUT
+from server import INVALID
+from unittests_base import TestGolfish
+
+class TestGolfishBatch(TestGolfish):
+    def test_run_batch(self):
+        jobs = [{"code": "IFLN|;", "input": "3", "id": "a"},
+                {"code": "1n0,"},
+                {"code": "5FLn|", "tick_limit": 20},
+                {"code": "0IFLP+|n;", "input": "99999999", "time_limit": 0.1},
+                {"input": "1"}]
+
+        results = sorted(run_batch(jobs, workers=2), key=lambda result: result["index"])
+
+        self.assertEqual([result["index"] for result in results], list(range(len(jobs))))
+        self.assertEqual([result["status"] for result in results],
+                         [HALTED, ERRORED, TIMED_OUT, OUT_OF_TIME, INVALID])
+        self.assertEqual(results[0]["stdout"], "0\n1\n2\n")
+        self.assertEqual(results[0]["id"], "a")
+        self.assertEqual(results[2]["ticks"], 21)
+        self.assertEqual(self.output(), "")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+from textwrap import dedent
+import unittest
+
+from compiler import CompileError, compile_program
+from golfish import Golfish, Playfield
+from library import *
+from unittests_base import TestGolfish
+
+class TestGolfishCompiler(TestGolfish):
+    def run_compiled_test(self, prog, output):
+        code, input_ = (prog, None) if isinstance(prog, str) else (prog[0], str(prog[1]))
+
+        compile_program(Playfield(code))
+        Golfish(code, input_, online=True, compiled=True).run()
+        self.assertEqual(self.output(), str(output))
+
+    def test_hello_world(self):
+        self.run_compiled_test('"!dlroW ,olleH"H', "Hello, World!")
+        self.run_compiled_test('S"Hello, World!";', "Hello, World!")
+
+    def test_quine(self):
+        self.run_compiled_test("'r3d*H", "'r3d*H")
+
+    def test_sum_loop(self):
+        code = dedent("""\
+                      0Iv
+                        >:?!v:@+$M
+                            >~n;""")
+
+        self.run_compiled_test((code, 100), 5050)
+
+    def test_longest_common_prefix(self):
+        code = dedent("""\
+                      i:a=q~v
+                      E;=Z;o>{:i""")
+
+        self.run_compiled_test((code, "global\nglossary"), "glo")
+        self.run_compiled_test((code, "glove\ndove"), "")
+
+    def test_dropsort(self):
+        code = dedent("""\
+                      I:N\\!
+                      ;EI/!~q)K2""")
+
+        self.run_compiled_test((code, "-7 -8 -5 0 -1 1 1 -5"), "-7\n-5\n0\n1\n1\n")
+
+    def test_switched(self):
+        self.run_compiled_test("!S1n2S3n;", "03.141592653589793")
+        self.run_compiled_test("12SD$nn;", "01")
+        self.run_compiled_test("123 2S]:+D;", "[2 6]\n")
+        self.run_compiled_test("12S]lnl;", "2")
+
+    def test_error_position(self):
+        self.run_compiled_test("1 0%", "something smells fishy... (instruction 37 '%' at 3,0)")
+
+    def test_fallback(self):
+        for code in ["IFLPN|;", "`;00p", "5V'0Q'|h'|3h"]:
+            with self.assertRaises(CompileError):
+                compile_program(Playfield(code))
+
+        gf = Golfish("0n`;00p", online=True, compiled=True)
+        gf.run()
+        self.assertEqual(self.output(), "0")
+
+if __name__ == '__main__':
+    unittest.main()
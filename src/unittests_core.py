@@ -1,9 +1,16 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import io
+import os
+import subprocess
 import sys
 from textwrap import dedent
+import time
 import unittest
 
-from golfish import Golfish
+from golfish import (BUDGET_EXHAUSTED, FLUSH_BLOCK, FLUSH_CHAR, FLUSH_LINE, HALTED,
+                     OUT_OF_MEMORY, OUT_OF_TIME, TIMED_OUT, WAITING_FOR_INPUT, Golfish,
+                     Playfield, TimeLimitExceeded)
 from library import *
 from unittests_base import TestGolfish
 
@@ -29,6 +36,292 @@ class TestGolfishCore(TestGolfish):
                       
         self.run_test(code, "a b\0")
 
+    def test_far_put(self):
+        self.run_test("`aff*:p ff*:go;", "a")
+        self.run_test("`am2pm2go;", "a")
+        self.run_test("`a52,:p52,:go;", "a")
+
+    def test_wrap_after_put(self):
+        self.run_test("1`ha0p", "1")
+        self.run_test("`h63p1v", "1")
+
+    def test_fractional_put(self):
+        # Wrapping up to a row p made at y = 2.5 puts the IP there, and the
+        # next step truncates it back onto the board
+        Golfish("`;052,p^\n       n", online=True, tick_limit=40).run()
+        self.assertEqual(self.output(), "00000000000\n[Timeout]")
+
+        board = Playfield("ab")
+        board.set(1, 0.5, 67)
+        self.assertEqual(board.cell(1, 0.5), 67)
+        self.assertEqual(board.cell(1, 0), 98)
+
+    def test_put_invalidates_trace(self):
+        self.run_test("0n`;00p", "0")
+        self.run_test("0n1n`;20p", "010")
+        self.run_test("0n1n `;40p", "0101")
+
+    def test_block_end_cache(self):
+        # The Q skip is looked up again after p removes its | and after V
+        # makes ' a variable, so both change where the skip lands
+        self.run_test("2F0Q|Ln84*40p|;", "0")
+
+        # The loop exits at the first | once ' is a variable, so the program
+        # falls through to the final | and errors
+        Golfish("2F0Q'|'|LnaV'~|;", online=True, tick_limit=10000).run()
+        self.assertEqual(self.output(),
+                         "02\nsomething smells fishy... (instruction 124 '|' at 14,0)")
+
+    def test_string_cache(self):
+        # p into a string that has already been pushed or printed
+        self.run_test("2F'ab'oo`c30p|;", "babc")
+        self.run_test('1S"ab"`c30pZ;00.', "abcb")
+
+    def test_playfield_read_does_not_grow(self):
+        board = Playfield("ab\n\ncd")
+
+        self.assertEqual(board.get(100, 100), 0)
+        self.assertEqual(board.get(-3, 1), 0)
+        self.assertFalse(board.has_row(1))
+        self.assertFalse(board.has_row(100))
+        self.assertEqual(board.max_row(), 2)
+        self.assertEqual(board.row_max(0), 1)
+
+        board.set(5, 1, 65)
+        board.set(1000, 0, 66)
+
+        self.assertTrue(board.has_row(1))
+        self.assertEqual(board.row_max(1), 5)
+        self.assertEqual(board.row_max(0), 1000)
+        self.assertIsNone(board.cell(4, 1))
+        self.assertEqual(board.get(1000, 0), 66)
+
+    def test_flush_policy(self):
+        class CountingIO(io.StringIO):
+            writes = 0
+
+            def write(self, s):
+                self.writes += 1
+                return super().write(s)
+
+        for policy, writes in [(FLUSH_CHAR, 20), (FLUSH_LINE, 10), (FLUSH_BLOCK, 1)]:
+            sys.stdout = CountingIO()
+            Golfish("aFLN|;", flush_policy=policy).run()
+
+            self.assertEqual(sys.stdout.writes, writes)
+            self.assertEqual(self.output(), "0\n1\n2\n3\n4\n5\n6\n7\n8\n9\n")
+
+    def test_long_input(self):
+        input_ = "Hello, World!" * 20000
+        Golfish("iE;o", input_, online=True).run()
+        self.assertEqual(self.output(), input_)
+
+        Golfish("iE;o", input_.encode(), online=True).run()
+        self.assertEqual(self.output(), input_)
+
+    def test_stdin(self):
+        stdin = sys.stdin
+
+        try:
+            for stream_input in [True, False]:
+                sys.stdin = io.TextIOWrapper(io.BytesIO("h\u00e9llo\r\nworld".encode()))
+                Golfish("iE;o", stream_input=stream_input).run()
+                self.assertEqual(self.output(), "h\u00e9llo\nworld")
+
+                sys.stdin = io.StringIO("1 2 3")
+                Golfish("IEhIEhIEh+*h", stream_input=stream_input).run()
+                self.assertEqual(self.output(), "5")
+
+        finally:
+            sys.stdin = stdin
+
+    def test_streams(self):
+        stdout, stderr = io.BytesIO(), io.StringIO()
+        stdin = io.BytesIO("h\u00e9llo".encode())
+        Golfish("iE;o", stdout=stdout, stderr=stderr, stdin=stdin).run()
+        Golfish("1n0,", stdout=stdout, stderr=stderr).run()
+
+        self.assertEqual(stdout.getvalue().decode(), "h\u00e9llo1")
+
+        # Bytes given as input_ are read the same way as bytes from stdin
+        for input_ in [io.BytesIO("h\u00e9\r\n".encode()), "h\u00e9\r\n".encode()]:
+            out = io.StringIO()
+
+            if isinstance(input_, bytes):
+                Golfish("iE;o", input_, stdout=out).run()
+            else:
+                Golfish("iE;o", stdout=out, stdin=input_).run()
+
+            self.assertEqual(out.getvalue(), "h\u00e9\n")
+        self.assertEqual(stderr.getvalue(), "\nsomething smells fishy... (instruction 44 ',' at 3,0)")
+
+        chunks = []
+        Golfish("aFLN|;", stdout=chunks.append, flush_policy=FLUSH_LINE).run()
+        self.assertEqual(chunks, ["{}\n".format(i) for i in range(10)])
+
+        # Interpreters on different threads keep their output apart
+        def run(n):
+            out = io.StringIO()
+            Golfish("IFLn|;", str(n), stdout=out, flush_policy=FLUSH_CHAR).run()
+            return out.getvalue()
+
+        with ThreadPoolExecutor(4) as executor:
+            outputs = list(executor.map(run, range(100, 120)))
+
+        self.assertEqual(outputs, ["".join(map(str, range(n))) for n in range(100, 120)])
+        self.assertEqual(self.output(), "")
+
+    def test_run_async(self):
+        async def session(code, chunks):
+            reader = asyncio.StreamReader()
+            out = io.StringIO()
+            task = asyncio.ensure_future(Golfish(code, stdout=out).run_async(reader, 10))
+
+            for chunk in chunks:
+                reader.feed_data(chunk)
+                await asyncio.sleep(0)
+
+            reader.feed_eof()
+            return await task, out.getvalue()
+
+        async def sessions():
+            return await asyncio.gather(session("IIIN+N;", [b"1", b"2 3", b"4", b" 5"]),
+                                        session("3Riooo;", ["h\u00e9l".encode()[:2], "h\u00e9l".encode()[2:]]),
+                                        session("0aaa**FL+|n;", []))
+
+        # Numbers and UTF-8 split across chunks, and R repeating input
+        self.assertEqual(asyncio.run(sessions()), [(HALTED, "5\n46\n"),
+                                                   (HALTED, "l\u00e9h"),
+                                                   (HALTED, "499500")])
+
+        # Turns come every yield_every ticks, even within an F loop run as
+        # one tick() by the fast path
+        async def race():
+            gf = Golfish("0aaa**FL+|n;", stdout=io.StringIO())
+            task = asyncio.ensure_future(gf.run_async(None, 10))
+            turns = 0
+
+            while not task.done():
+                turns += 1
+                await asyncio.sleep(0)
+
+            return turns, gf._ticks
+
+        turns, ticks = asyncio.run(race())
+        self.assertGreaterEqual(turns, ticks // 10)
+
+    def test_budget(self):
+        # Running in slices, moving to a fresh interpreter between each,
+        # ends up just like running in one go
+        for code, input_ in [("IFLPN|;", "5"),
+                             ('`e2RFL5%zR"zzuB"L3%zR"zziF"lQlRoaoC|LN|;', None),
+                             ("1AFIFh\n:2(?BM:MF$F+B", "10"),
+                             ("I2wmkMW2K%qPC:N:},{|;", "120"),
+                             ("iEv:2gP$2p\nrH>ff*FL2gRL|", "Hello, World!"),
+                             ("aFSxN|;", None)]:
+
+            out = io.StringIO()
+            gf = Golfish(code, input_, stdout=out, seed=1)
+            self.assertEqual(gf.run(), HALTED)
+            expected = (out.getvalue(), gf._ticks)
+
+            out = io.StringIO()
+            gf = Golfish(code, input_, stdout=out, seed=1)
+
+            while gf.run(max_ticks=3) == BUDGET_EXHAUSTED:
+                snapshot = gf.snapshot()
+                gf = Golfish(code, input_, stdout=out, seed=1)
+                gf.restore(snapshot)
+
+            self.assertEqual((out.getvalue(), gf._ticks), expected)
+            self.assertEqual(gf.run(), HALTED)
+
+    def test_budget_compiled(self):
+        # The compiled program only ever starts a fresh run, never one which
+        # is under way or restored
+        code = "1n2n3n4n5n;"
+
+        out = io.StringIO()
+        gf = Golfish(code, compiled=True, stdout=out)
+        self.assertEqual(gf.run(max_ticks=4), BUDGET_EXHAUSTED)
+        self.assertEqual(gf.run(), HALTED)
+        self.assertEqual(out.getvalue(), "12345")
+
+        out = io.StringIO()
+        gf = Golfish(code, stdout=out)
+        gf.run(max_ticks=4)
+
+        restored = Golfish(code, compiled=True, stdout=out)
+        restored.restore(gf.snapshot())
+        self.assertEqual(restored.run(), HALTED)
+        self.assertEqual(out.getvalue(), "12345")
+
+        out = io.StringIO()
+        gf = Golfish(code, compiled=True, stdout=out)
+        self.assertEqual(gf.run(), HALTED)
+        self.assertEqual((out.getvalue(), gf._ticks), ("12345", 11))
+
+    def test_waiting_for_input(self):
+        out = io.StringIO()
+        gf = Golfish("IIIN+N;", stdout=out)
+
+        self.assertEqual(gf.run(max_ticks=100), WAITING_FOR_INPUT)
+        gf.feed_input("12 3")
+        self.assertEqual(gf.run(max_ticks=100), WAITING_FOR_INPUT)
+
+        snapshot = gf.snapshot()
+        gf = Golfish("IIIN+N;", stdout=out)
+        gf.restore(snapshot)
+
+        gf.feed_input(b"4 5")
+        gf.feed_input(b"")
+        self.assertEqual(gf.run(max_ticks=100), HALTED)
+        self.assertEqual(out.getvalue(), "5\n46\n")
+
+    def test_limits(self):
+        # Programs within the limits run just as they would without them
+        for code, input_ in [("IFLPN|;", "5"), ("I2wmkMW2K%qPC:N:},{|;", "120")]:
+            out = io.StringIO()
+            gf = Golfish(code, input_, stdout=out)
+            gf.run()
+            expected = (out.getvalue(), gf._ticks)
+
+            out = io.StringIO()
+            gf = Golfish(code, input_, stdout=out, time_limit=60, memory_limit=1000)
+            self.assertEqual(gf.run(), HALTED)
+            self.assertEqual((out.getvalue(), gf._ticks), expected)
+
+        for code, limits, status, message in [
+                (" ", {"time_limit": 0.05}, OUT_OF_TIME, "[Time limit]"),
+                ("1", {"memory_limit": 10000}, OUT_OF_MEMORY, "[Memory limit]"),
+                ("ffff***K;", {"memory_limit": 10000}, OUT_OF_MEMORY, "[Memory limit]"),
+                ("ffff***R1;", {"memory_limit": 10000}, OUT_OF_MEMORY, "[Memory limit]"),
+                ("1", {"tick_limit": 100, "memory_limit": 10000}, TIMED_OUT, "[Timeout]")]:
+
+            err = io.StringIO()
+            gf = Golfish(code, stderr=err, **limits)
+
+            self.assertEqual(gf.run(), status)
+            self.assertEqual(err.getvalue(), message)
+
+        # abort() stops a program from outside, as a timer signal would, but
+        # leaves one which has already stopped alone
+        err = io.StringIO()
+        gf = Golfish("1n", stdout=io.StringIO(), stderr=err)
+        self.assertEqual(gf.run(max_ticks=3), BUDGET_EXHAUSTED)
+        self.assertIsNone(gf.status())
+        self.assertEqual(gf.abort(TimeLimitExceeded()), OUT_OF_TIME)
+        self.assertEqual((gf.status(), gf.ticks(), err.getvalue()), (OUT_OF_TIME, 3, "\n[Time limit]"))
+
+        gf = Golfish("1n;", stdout=io.StringIO())
+        gf.run()
+        self.assertEqual(gf.abort(TimeLimitExceeded()), HALTED)
+
+        # A long R is checked as it goes, not only once it is over
+        gf = Golfish("ffff***R1;", stderr=io.StringIO(), memory_limit=10000)
+        gf.run()
+        self.assertLess(len(gf._curr_stack), 20000)
+
     def test_eof(self):
         self.run_test(("INE;IN;", "5"), "5\n-1\n")
         self.run_test(("INE;IN;", "5 "), "5\n-1\n")
@@ -43,6 +336,124 @@ class TestGolfishCore(TestGolfish):
     def test_alias_block(self):
         self.run_test("5A'0Q'|h'|5h", "0")
 
+    def test_for_fast_path(self):
+        # Straight-line F bodies are run by run_for_loop, which has to keep
+        # L, closures and the tick count the same as running tick by tick
+        for code, output in [("aFLN|;", "0\n1\n2\n3\n4\n5\n6\n7\n8\n9\n"),
+                             ("3j2FL|D;", "[3 0 3 1]\n"),
+                             ("0F|Ln;", "0"),
+                             ("2F3FL|L|Ln;", "2"),
+                             ("5FLn|", "01234" * 4 + "012\n[Timeout]"),
+                             # F entered from off the board, with no | to be found
+                             ("a<;?=5n:LF", "012345"),
+                             ("v   F\n>a:*v\n    L\n    n",
+                              "0" + "".join(map(str, range(23))) + "\n[Timeout]")]:
+
+            ticks = []
+
+            for fast in [True, False]:
+                gf = Golfish(code, online=True, tick_limit=100)
+
+                if not fast:
+                    gf.loop_body = lambda: None
+
+                gf.run()
+                self.assertEqual(self.output(), output)
+                ticks.append(gf._ticks)
+
+            self.assertEqual(ticks[0], ticks[1])
+
+    def test_for_fast_path_limits(self):
+        # Stopping for a limit check or a budget only takes the iteration it
+        # falls in off the fast path, so limits stay cheap
+        timings = []
+
+        for limits in [{}, {"time_limit": 100}, {"memory_limit": 10**9}, {"tick_limit": 10**9}]:
+            out = io.StringIO()
+            gf = Golfish("0IFLP+|n;", "30000", stdout=out, **limits)
+            calls = []
+            tick = gf.tick
+            gf.tick = lambda: calls.append(tick())
+
+            start = time.perf_counter()
+            self.assertEqual(gf.run(), HALTED)
+            timings.append(time.perf_counter() - start)
+
+            self.assertEqual((out.getvalue(), gf._ticks), ("450015000", 150004))
+            self.assertLess(len(calls), 1000)
+
+        self.assertLess(max(timings), 2*timings[0] + 0.1)
+
+        out = io.StringIO()
+        gf = Golfish("0IFLP+|n;", "30000", stdout=out)
+
+        while gf.run(max_ticks=10000) == BUDGET_EXHAUSTED:
+            snapshot = gf.snapshot()
+            gf = Golfish("0IFLP+|n;", "30000", stdout=out)
+            gf.restore(snapshot)
+
+        self.assertEqual((out.getvalue(), gf._ticks), ("450015000", 150004))
+
+    def test_memoize_aliases(self):
+        fib = dedent("""\
+                     1AFIFh
+                     :2(?BM:MF$F+B""")
+
+        gf = Golfish(fib, "20", online=True, memoize_aliases=True)
+        gf.run()
+        self.assertEqual(self.output(), "6765")
+        self.assertLess(gf._ticks, 1000)
+        self.assertEqual(gf._alias_memo.hits, 18)
+
+        # Functions with output are run every time
+        code = dedent("""\
+                      1Ad 5dN 5dN ;
+                      :n2*B""")
+
+        gf = Golfish(code, online=True, memoize_aliases=True)
+        gf.run()
+        self.assertEqual(self.output(), "510\n510\n")
+        self.assertEqual(len(gf._alias_memo), 0)
+
+        # p drops every cached result
+        Golfish("1Ad 5dn `301p 5dn;\n2*B", online=True, memoize_aliases=True).run()
+        self.assertEqual(self.output(), "1015")
+
+    def test_seed(self):
+        # x, Sx and SP draw from a per-interpreter RNG, so a seed fixes them
+        for code, compiled in [("aFSxN|;", False), ("SxnSxn;", True)]:
+            outputs = []
+
+            for seed in [1, 1, 2]:
+                Golfish(code, online=True, compiled=compiled, seed=seed).run()
+                outputs.append(self.output())
+
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertNotEqual(outputs[0], outputs[2])
+
+    def test_is_probably_prime(self):
+        primes = [n for n in range(100) if all(n % d for d in range(2, n))]
+        self.assertEqual([n for n in range(-5, 100) if is_probably_prime(n)], primes[2:])
+
+        # Strong pseudoprimes to several small bases, beyond the sieve
+        for n in [3215031751, 3825123056546413051, 318665857834031151167461]:
+            self.assertFalse(is_probably_prime(n))
+
+        for n in [65537, 2**61 - 1, 2**89 - 1, 2**127 - 1]:
+            self.assertTrue(is_probably_prime(n))
+
+    def test_lazy_imports(self):
+        # Modules only some programs need aren't imported with golfish
+        code = ("import sys, golfish; golfish.Golfish('1n;').run(); "
+                "print(sorted(set(sys.argv[1:]) & set(sys.modules)))")
+        lazy = ["argparse", "getch", "random", "sympy", "termios", "traceback"]
+
+        result = subprocess.run([sys.executable, "-c", code] + lazy,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, universal_newlines=True)
+
+        self.assertEqual(result.stdout, "1[]\n")
+
     def test_QL(self):
         self.run_test("5F1QL||D;", "[0 1 2 3 4]\n")
 
@@ -60,6 +60,10 @@ class TestGolfishInstructions(TestGolfish):
 
                 self.run_test("{}{}{}h".format(sa, sb, inst), expected)
 
+        # Integral floats are normalised, however they were made
+        self.run_test("12,12,+:h", "1")
+        self.run_test("12,4*D;", "[2]\n")
+
     def test_push_num(self):
         for n, c in enumerate("m0123456789abcdef", start=-1):
             self.run_test(c + "h", n)
@@ -197,6 +201,10 @@ class TestGolfishInstructions(TestGolfish):
 
     def test_square_brackets(self):
         self.run_test("12345D 3]D ++[D;", "[1 2 3 4 5]\n[3 4 5]\n[1 2 12]\n")
+        self.run_test("1235]D;", "[0 0 1 2 3]\n")
+        self.run_test("1230]DyD;", "[]\n[1 2 3]\n")
+        self.run_test("1235S]DyD;", "[0 0 1 2 3]\n[0 0 1 2 3]\n")
+        self.run_test("12345 2S]DyD;", "[4 5]\n[1 2 3 4 5]\n")
 
     def test_backtick(self):
         self.run_test("`'``a`a`b`HH", "Hba\n`'")
@@ -269,6 +277,8 @@ class TestGolfishInstructions(TestGolfish):
         self.run_test("5DzDzD;", "[5]\n[0]\n[1]\n")
 
     def test_brace(self):
+        self.run_test("{D;", "[0]\n")
+        self.run_test("}D;", "[0]\n")
         self.run_test("1234D{D{D}D}D;", "[1 2 3 4]\n[2 3 4 1]\n[3 4 1 2]"
                                         "\n[2 3 4 1]\n[1 2 3 4]\n")
 
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+import io
+import json
+import unittest
+from unittest import mock
+
+from golfish import ERRORED, HALTED, OUT_OF_TIME, TIMED_OUT, Playfield, TimeLimitExceeded
+from server import INVALID, Server
+from unittests_base import TestGolfish
+
+class TestGolfishServer(TestGolfish):
+    def serve(self, *requests, **kwargs):
+        infile = io.StringIO("".join(json.dumps(request) + "\n" for request in requests))
+        outfile = io.StringIO()
+
+        Server(**kwargs).serve(infile, outfile)
+        return [json.loads(line) for line in outfile.getvalue().splitlines()]
+
+    def test_serve(self):
+        responses = self.serve({"code": '"!dlroW ,olleH"H'},
+                               {"code": "IFLN|;", "input": "3", "id": 7},
+                               {"code": "1n0,"},
+                               {"code": "5FLn|", "tick_limit": 20})
+
+        self.assertEqual(responses[0], {"stdout": "Hello, World!", "stderr": "",
+                                        "ticks": 1, "status": HALTED})
+        self.assertEqual(responses[1]["stdout"], "0\n1\n2\n")
+        self.assertEqual(responses[1]["id"], 7)
+        self.assertEqual(responses[2]["status"], ERRORED)
+        self.assertEqual(responses[2]["stderr"], "\nsomething smells fishy... (instruction 44 ',' at 3,0)")
+        self.assertEqual(responses[3]["status"], TIMED_OUT)
+        self.assertEqual(responses[3]["ticks"], 21)
+
+        # Nothing leaks onto the real stdout
+        self.assertEqual(self.output(), "")
+
+    def test_invalid_request(self):
+        responses = self.serve({"input": "1"}, {"code": 5}, {"code": "1n;"})
+
+        self.assertEqual([response["status"] for response in responses],
+                         [INVALID, INVALID, HALTED])
+
+    def test_board_cache(self):
+        # Each run gets its own copy of the board, whatever earlier runs p
+        code = "00gn`200p;"
+
+        with mock.patch.object(Playfield, "_copy", autospec=True,
+                               side_effect=Playfield._copy) as copy:
+
+            responses = self.serve({"code": code}, {"code": code}, tick_limit=100)
+
+        self.assertEqual([response["stdout"] for response in responses], ["48", "48"])
+        self.assertEqual(copy.call_count, 2) # one per run
+
+    def test_late_timer(self):
+        # A time limit going off as run() finishes doesn't take the server
+        # down, and the program keeps whatever status it ended with
+        @contextmanager
+        def late_limit(seconds):
+            yield
+            raise TimeLimitExceeded
+
+        with mock.patch("server.wall_clock_limit", late_limit):
+            responses = self.serve({"code": "1n;", "time_limit": 1},
+                                   {"code": "1n", "time_limit": 1, "tick_limit": 10},
+                                   {"code": "2n;"})
+
+        self.assertEqual([(response["stdout"], response["status"]) for response in responses],
+                         [("1", HALTED), ("11111", TIMED_OUT), ("2", HALTED)])
+
+    def test_time_limit(self):
+        responses = self.serve({"code": " ", "time_limit": 0.05})
+
+        self.assertEqual(responses[0]["status"], OUT_OF_TIME)
+        self.assertEqual(responses[0]["stderr"], "[Time limit]")
+
+if __name__ == '__main__':
+    unittest.main()